@@ -10,22 +10,58 @@
 #   2021-09-14  Todd Valentic
 #               Initial implementation. Adapted for mango
 #
+#   2026-10-17  Todd Valentic
+#               Only read the record headers (metadata_only)
+#
+#   2026-10-17  Todd Valentic
+#               Add batch.size and batch.time options
+#
+#   2026-10-17  Todd Valentic
+#               Add cache.time option
+#
+#   2026-10-17  Todd Valentic
+#               Process attachments in memory (spill.size)
+#
+#   2026-10-17  Todd Valentic
+#               Add per stage ingest metrics (metrics.*)
+#
+#   2026-10-17  Todd Valentic
+#               Create the stores on first use of each datatype
+#
+#   2026-10-17  Todd Valentic
+#               Build quicklook movies as images arrive (quicklook.*)
+#
+#   2026-10-17  Todd Valentic
+#               Share one quicklook builder, recover its open segments
+#               at start and close them on exit
+#
+#   2026-10-17  Todd Valentic
+#               Only import quicklook (and h5py) when it is used
+#
+#   2026-10-17  Todd Valentic
+#               Add batch.retries option
+#
 ########################################################################
 
 from Transport  import ProcessClient
 from Transport  import NewsPollMixin
 from Transport  import NewsTool
 
+import io
 import os
 import sys
+import time
 import fnmatch
 
 import model
+import metrics
 import artemis_store
 
+# Store classes, instantiated on first use (see getStore)
+
 DataProcessor = {
-    'greenline':        artemis_store.Store(),
-    'redline':          artemis_store.Store(),
+    'greenline':        artemis_store.Store,
+    'redline':          artemis_store.Store,
     }
 
 DataFiles = {
@@ -39,8 +75,167 @@ class StoreDB(ProcessClient,NewsPollMixin):
         ProcessClient.__init__(self,args)
         NewsPollMixin.__init__(self,callback=self.process)
 
+        self.batchSize = self.getint('batch.size',0)
+        self.batchTime = self.getint('batch.time',60)
+        self.batchRetries = self.getint('batch.retries',3)
+        self.cacheTime = self.getint('cache.time',3600)
+        self.stores = {}
+        self.quicklook = None
+
+        # Quicklook movies need the pixels, so the full records
+        # are decoded when quicklook.path is set
+
+        self.quicklookPath = self.get('quicklook.path')
+        self.quicklookSize = self.getint('quicklook.size',256)
+        self.quicklookIdle = self.getint('quicklook.idle',7200)
+        self.quicklookOffset = self.getint('quicklook.offset',0)
+        self.quicklookRate = self.getint('quicklook.rate',10)
+        self.quicklookMovie = self.getboolean('quicklook.movie',False)
+        self.quicklookEncoder = self.get('quicklook.encoder')
+
+        # Attachments larger than this (bytes) are written to disk
+
+        self.spillSize = self.getint('spill.size',16*1024*1024)
+
+        # Ingest metrics, written to metrics.file and/or served on
+        # metrics.port, with a summary in the log every metrics.summary
+
+        self.metricsFile = self.get('metrics.file')
+        self.metricsPort = self.getint('metrics.port',0)
+        self.metricsRate = self.getint('metrics.rate',15)
+        self.metricsSummary = self.getint('metrics.summary',600)
+        self.metricsWritten = 0
+        self.fetchStart = None
+
+        if self.getboolean('metrics',False) or self.metricsFile or self.metricsPort:
+            metrics.enable()
+
+        if self.metricsPort:
+            address = self.get('metrics.address','127.0.0.1')
+            metrics.serve(self.metricsPort,address)
+            self.log.info('Serving metrics on %s:%d' % (address,self.metricsPort))
+
+    def wait(self,*pos,**kw):
+
+        # Write any queued records before sleeping until the next poll
+
+        self.flush()
+        self.reportMetrics()
+
+        result = ProcessClient.wait(self,*pos,**kw)
+
+        self.fetchStart = time.time()
+
+        return result
+
+    def reportMetrics(self):
+
+        if not metrics.registry:
+            return
+
+        now = time.time()
+
+        if self.metricsFile and now-self.metricsWritten >= self.metricsRate:
+            try:
+                metrics.registry.write(self.metricsFile)
+            except:
+                self.log.exception('Failed to write %s' % self.metricsFile)
+            self.metricsWritten = now
+
+        if self.metricsSummary:
+            if now-metrics.registry.lastSummary >= self.metricsSummary:
+                for line in metrics.registry.summary():
+                    self.log.info(line)
+
+    def getStore(self,datatype):
+
+        if datatype not in self.stores:
+            self.stores[datatype] = DataProcessor[datatype](
+                                        batchSize=self.batchSize,
+                                        batchTime=self.batchTime,
+                                        batchRetries=self.batchRetries,
+                                        cacheTime=self.cacheTime)
+
+            if self.quicklookPath:
+                self.stores[datatype].quicklook = self.getQuickLook(
+                                        self.stores[datatype])
+
+        return self.stores[datatype]
+
+    def getQuickLook(self,store):
+
+        # One builder (segments are per station/instrument) writing
+        # its rows through the first store
+
+        if not self.quicklook:
+
+            # Imported here, it loads h5py
+
+            import quicklook
+
+            if self.quicklookMovie:
+                encoder = self.quicklookEncoder or quicklook.Encoder
+            else:
+                encoder = None
+
+            self.quicklook = quicklook.QuickLookBuilder(
+                                store,
+                                self.quicklookPath,
+                                size=self.quicklookSize,
+                                idle=self.quicklookIdle,
+                                offset=self.quicklookOffset,
+                                encoder=encoder,
+                                rate=self.quicklookRate)
+            self.quicklook.recover()
+
+        return self.quicklook
+
+    def flush(self):
+
+        # Close idle quicklook segments first, their rows are
+        # written with the rest of the batch
+
+        if self.quicklook:
+            self.quicklook.closeIdle()
+
+        # Rows that fail to commit stay queued for the next flush
+        # until they are dropped (see StoreBase.retry)
+
+        for store in self.stores.values():
+            store.flush()
+
+    def finish(self):
+
+        # Close the open quicklook segments (waiting for their movies)
+        # and write what is still queued
+
+        if self.quicklook:
+            self.quicklook.closeAll()
+
+        self.flush()
+
     def process(self,message):
 
+        # The news poller marks the message as read when we return,
+        # so messages are handled one at a time. Decoding and writing
+        # could only overlap across messages if the acks waited for
+        # the commit, which the poller does not support.
+
+        # The poller fetches the next article between our calls
+
+        if self.fetchStart:
+            fetchTime = time.time()-self.fetchStart
+        else:
+            fetchTime = None
+
+        try:
+            self.processMessage(message,fetchTime)
+        finally:
+            self.fetchStart = time.time()
+            self.reportMetrics()
+
+    def processMessage(self,message,fetchTime=None):
+
         # newsgroup: transport.mango.station.<sitename>.outbound.<instrument>
         #                0       1      2         3         4         5
         # i.e. transport.mango.station.lwl.outbound.greenline
@@ -50,7 +245,7 @@ class StoreDB(ProcessClient,NewsPollMixin):
         datatype  = newsgroup[-1]
         location  = newsgroup[1]
         sitename  = newsgroup[3]
-        store     = DataProcessor[datatype]
+        store     = self.getStore(datatype)
         timestamp = NewsTool.messageDate(message)
 
         self.log.info('%s - %s - %s' % (sitename,datatype,timestamp))
@@ -60,12 +255,56 @@ class StoreDB(ProcessClient,NewsPollMixin):
                 datatype=datatype,
                 location=location,
                 sitename=sitename,
-                timestamp=timestamp)
+                timestamp=timestamp,
+                metadata_only=not self.quicklookPath)
+
+        with metrics.labels(station=sitename,datatype=datatype):
+
+            metrics.count('messages')
+
+            if fetchTime is not None:
+                metrics.observe('fetch',fetchTime)
+
+            for filename,fileobj in self.attachments(message,DataFiles[datatype]):
+                metrics.count('files')
+                try:
+                    store.process(filename,opts=opts,fileobj=fileobj)
+                finally:
+                    if fileobj is None:
+                        os.remove(filename)
+
+    def attachments(self,message,patterns):
+
+        # Yield (filename,fileobj) for the attachments that match
+        # patterns. Small attachments are kept in memory, larger
+        # ones are saved to disk and fileobj is None.
+
+        for part in message.walk():
+
+            filename = part.get_filename()
+
+            if not filename:
+                continue
+
+            filename = os.path.basename(filename)
+
+            if not self.matchFilename(filename,patterns):
+                continue
+
+            start = time.time()
+
+            data = part.get_payload(decode=True)
+            metrics.count('bytes',len(data))
 
-        for filename in NewsTool.saveFiles(message):
-            if self.matchFilename(filename,DataFiles[datatype]):
-                store.process(filename,opts=opts)
-            os.remove(filename)
+            if len(data) > self.spillSize:
+                with open(filename,'wb') as output:
+                    output.write(data)
+                del data
+                metrics.observe('attachments',time.time()-start)
+                yield filename,None
+            else:
+                metrics.observe('attachments',time.time()-start)
+                yield filename,io.BytesIO(data)
 
     def matchFilename(self,filename,patterns):
 
@@ -76,5 +315,9 @@ class StoreDB(ProcessClient,NewsPollMixin):
         return False
 
 if __name__ == '__main__':
-    StoreDB(sys.argv).run()
+    client = StoreDB(sys.argv)
+    try:
+        client.run()
+    finally:
+        client.finish()
 
@@ -8,13 +8,21 @@
 #   2021-07-16  Todd Valentic
 #               Initial implementation
 #
+#   2026-10-17  Todd Valentic
+#               Query stations over a pooled connection, cache list
+#
+#   2026-10-17  Todd Valentic
+#               Handle connection errors, retry failed directories
+#
 ##########################################################################
 
 from postfiles import PostFiles
 
 import os
 import sys
-import commands
+import time
+import psycopg2
+import psycopg2.pool
 
 class ExportFiles(PostFiles):
 
@@ -22,34 +30,68 @@ class ExportFiles(PostFiles):
         PostFiles.__init__(self, argv)
 
         self.exportPath = self.get('path.project.export','.')
+        self.stationsDSN = self.get('stations.database','dbname=tincan.v1-prod')
+        self.stationsRefresh = self.getint('stations.refresh',600)
+
+        self.pool = None
+        self.stations = set()
+        self.stationsTime = 0
 
     def preprocess(self):
 
+        # Only make the directories for newly added stations. Those
+        # that failed are tried again on the next refresh.
+
+        if time.time()-self.stationsTime < self.stationsRefresh:
+            return
+
         stations = self.listStations()
 
-        for station in stations:
+        if stations is None:
+            return
+
+        created = set()
+
+        for station in sorted(stations - self.stations):
             try:
-                self.createFiles(station)
+                if self.createFiles(station):
+                    created.add(station)
             except:
-                self.log.exceptions('Failed to make dirs for %s' % station)
+                self.log.exception('Failed to make dirs for %s' % station)
+
+        self.stations = (stations & self.stations) | created
+        self.stationsTime = time.time()
 
     def listStations(self):
 
         sql = 'select name from mesh_node where active=true'
-        sqlcmd = 'psql -d tincan.v1-prod -t -c "%s"' % sql
 
-        status, output = commands.getstatusoutput(sqlcmd)
+        conn = None
+
+        try:
+            if not self.pool:
+                self.pool = psycopg2.pool.SimpleConnectionPool(1,1,self.stationsDSN)
+            conn = self.pool.getconn()
+            with conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(sql)
+                    stations = set(row[0] for row in cursor)
+        except psycopg2.Error:
+            # Drop the connection, it is reopened on the next call
+            if conn is not None:
+                self.pool.putconn(conn,close=True)
+            self.log.exception('Failed to get station list')
+            return None
 
-        if status == 0:
-            return output.split()
-        else:
-            self.log.error('Failed to get station list')
-            self.log.error('cmd=%s' % sqlcmd)
-            self.log.error('output=%s' % output)
-            return []
+        self.pool.putconn(conn)
+
+        return stations
 
     def createFiles(self, station): 
 
+        # Returns False if a directory could not be made
+
+        created = True
         basepath = os.path.join(self.exportPath, station)
 
         for filegroup in self.filegroups:
@@ -62,8 +104,11 @@ class ExportFiles(PostFiles):
                     self.log.info('Creating %s' % path)
                 except:
                     self.log.exception('Failed to create %s' % path)
+                    created = False
                 finally:
                     os.umask(original_umask)
+
+        return created
         
 if __name__ == '__main__':
     ExportFiles(sys.argv).run()
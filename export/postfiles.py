@@ -20,6 +20,48 @@
 #               Add serialNum option
 #               Use path, filename, pathname nomenclature
 #
+#   2026-10-17  Todd Valentic
+#               Replace find with an incremental scandir manifest
+#
+#   2026-10-17  Todd Valentic
+#               Add inotify watch mode
+#
+#   2026-10-17  Todd Valentic
+#               Post to different newsgroups concurrently (post.workers)
+#
+#   2026-10-17  Todd Valentic
+#               Streaming and parallel (multi-stream) bz2 compression
+#
+#   2026-10-17  Todd Valentic
+#               Per filegroup compression policy (codec, minsize, probe)
+#
+#   2026-10-17  Todd Valentic
+#               Optionally bundle small files into one post
+#
+#   2026-10-17  Todd Valentic
+#               Configurable, precompiled filename time patterns
+#               Optionally order files by data time (sortByTime)
+#
+#   2026-10-17  Todd Valentic
+#               Parallel compression with lbzip2/pigz (single stream),
+#               off by default (compress.parallel)
+#
+#   2026-10-17  Todd Valentic
+#               Invalidate watched directories under the lock
+#
+#   2026-10-17  Todd Valentic
+#               Require parseTime.format with parseTime.regex
+#
+#   2026-10-17  Todd Valentic
+#               Never compress .bz2/.gz/.xz/.zip/.tgz files again
+#
+#   2026-10-17  Todd Valentic
+#               Parse each time once (failures are cached too)
+#
+#   2026-10-17  Todd Valentic
+#               Only save the manifest when it has changed
+#               Iterative prefixMatch, prune on match.depth
+#
 ############################################################################
 
 from Transport      import ProcessClient
@@ -32,12 +74,457 @@ import re
 import os
 import bz2
 import sys
+import zlib
+import shutil
 import time
-import commands
 import pytz
+import errno
+import struct
+import select
+import subprocess
+import ctypes
+import ctypes.util
+import fnmatch
+import cPickle
+import Queue
 import datetime
+import tempfile
+import threading
+import multiprocessing
 import uuid
 
+from distutils.spawn import find_executable
+
+from collections import OrderedDict
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+def patternTokens(pattern):
+
+    # Split an fnmatch pattern into '*', '?', [...] sets and literal
+    # characters
+
+    tokens = []
+    k = 0
+
+    while k < len(pattern):
+        if pattern[k] == '[':
+            end = pattern.find(']', k+2)
+            if end > 0:
+                tokens.append(pattern[k:end+1])
+                k = end+1
+                continue
+        tokens.append(pattern[k])
+        k += 1
+
+    return tokens
+
+def prefixMatch(tokens, text, levels=None):
+
+    # Return True if text can be extended to match the pattern
+    # (see patternTokens) with at most levels more '/'. Like find
+    # -path, '*' also matches '/'. The positions in the pattern
+    # that text can reach are tracked together, so there is no
+    # backtracking. The literal '/' left in the pattern after a
+    # position are the directories it still needs.
+
+    def closure(states):
+        for state in sorted(states):
+            while state < len(tokens) and tokens[state] == '*':
+                state += 1
+                states.add(state)
+        return states
+
+    states = closure(set([0]))
+
+    for char in text:
+        following = set()
+        for state in states:
+            if state == len(tokens):
+                continue
+            token = tokens[state]
+            if token == '*':
+                following.add(state)
+            elif token == '?' or token == char or \
+                 (len(token) > 1 and fnmatch.fnmatchcase(char, token)):
+                following.add(state+1)
+        if not following:
+            return False
+        states = closure(following)
+
+    if levels is None:
+        return True
+
+    return any(tokens[state:].count('/') <= levels for state in states)
+
+class Manifest:
+
+    # Persistent record of the files seen under a directory tree.
+    #
+    #   dirs: path -> (mtime, subdirs, files)
+    #   files: filename -> (mtime, size, posted)
+    #
+    # A directory's mtime only changes when entries are added or
+    # removed, so unchanged directories are not listed again. Files
+    # rewritten in place are caught by a periodic full rescan.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.dirs = {}
+        self.dirty = False
+
+        if os.path.isfile(filename):
+            with open(filename, 'rb') as f:
+                self.dirs = cPickle.load(f)
+
+    def save(self):
+
+        # Only written when something has changed
+
+        if not self.dirty:
+            return
+
+        tmpname = self.filename + '.tmp'
+
+        with open(tmpname, 'wb') as f:
+            cPickle.dump(self.dirs, f, 2)
+
+        os.rename(tmpname, self.filename)
+
+        self.dirty = False
+
+    def scan(self, path, prune, select, full=False):
+
+        # Return the files below path that are new, have changed or
+        # have not been posted yet. Directories where prune(path) is
+        # True are skipped and only files where select(pathname) is
+        # True are recorded.
+
+        changed = []
+        stack = [path]
+
+        while stack:
+
+            path = stack.pop()
+
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                self.forget(path)
+                continue
+
+            current = self.dirs.get(path)
+
+            if current and current[0] == mtime and not full:
+                for filename, record in current[2].items():
+                    if not record[2]:
+                        changed.append(os.path.join(path, filename))
+                stack.extend(current[1])
+                continue
+
+            previous = current[2] if current else {}
+            subdirs = []
+            files = {}
+
+            for entry in scandir(path):
+
+                if entry.is_dir(follow_symlinks=False):
+                    if not prune(entry.path):
+                        subdirs.append(entry.path)
+                    continue
+
+                if not entry.is_file() or not select(entry.path):
+                    continue
+
+                stat = entry.stat()
+                record = previous.get(entry.name)
+
+                if not record or record[:2] != (stat.st_mtime, stat.st_size):
+                    record = (stat.st_mtime, stat.st_size, False)
+
+                files[entry.name] = record
+
+                if not record[2]:
+                    changed.append(entry.path)
+
+            if current:
+                for subdir in set(current[1]) - set(subdirs):
+                    self.forget(subdir)
+
+            if (mtime, subdirs, files) != current:
+                self.dirs[path] = (mtime, subdirs, files)
+                self.dirty = True
+
+            stack.extend(subdirs)
+
+        return changed
+
+    def invalidate(self, path):
+
+        # Force the directory to be listed on the next scan
+
+        if path in self.dirs:
+            mtime, subdirs, files = self.dirs[path]
+            self.dirs[path] = (None, subdirs, files)
+            self.dirty = True
+
+    def forget(self, path):
+
+        # Drop a directory tree that has gone away
+
+        prefix = path + os.sep
+
+        for dirname in list(self.dirs):
+            if dirname == path or dirname.startswith(prefix):
+                del self.dirs[dirname]
+                self.dirty = True
+
+    def get(self, pathname):
+        path, filename = os.path.split(pathname)
+        return self.dirs[path][2][filename]
+
+    def posted(self, pathname, mtime, size):
+        path, filename = os.path.split(pathname)
+        self.dirs[path][2][filename] = (mtime, size, True)
+        self.dirty = True
+
+    def remove(self, pathname):
+        path, filename = os.path.split(pathname)
+        if path in self.dirs:
+            if self.dirs[path][2].pop(filename, None):
+                self.dirty = True
+
+#-- Filename times ---------------------------------------------------------
+
+class TimePattern:
+
+    # Timestamp embedded in a filename. The regex is compiled once.
+    # If fields is given, the matched text is sliced at fixed offsets
+    # (year, month, day, hour, minute, second) instead of strptime.
+
+    def __init__(self, regex, timefmt=None, fields=None):
+        self.regex = re.compile(regex)
+        self.timefmt = timefmt
+        self.fields = fields
+
+    def parse(self, filename):
+
+        match = self.regex.search(filename)
+
+        if not match:
+            return None
+
+        timestr = match.group(0)
+
+        try:
+            if self.fields:
+                values = [int(timestr[a:b]) for a,b in self.fields]
+                return datetime.datetime(*values, tzinfo=pytz.utc)
+            timestamp = datetime.datetime.strptime(timestr,self.timefmt)
+        except ValueError:
+            return None
+
+        return timestamp.replace(tzinfo=pytz.utc)
+
+# Standard format - 20190802-200555C00SEQ01.ntf
+# Log format      - hs-07-20190803-165804.log
+# MANGO format    - mango-low-greenline-20210813-042400.png
+# VMTI format     - vmti_08-02-2019_UTC20-04-55_0000_00.4607
+
+StandardTime = TimePattern(r'\d{8}.\d{6}',
+                    fields=[(0,4),(4,6),(6,8),(9,11),(11,13),(13,15)])
+
+VMTITime = TimePattern(r'\d{2}-\d{2}-\d{4}_UTC\d{2}-\d{2}-\d{2}',
+                    fields=[(6,10),(0,2),(3,5),(14,16),(17,19),(20,22)])
+
+TimePatterns = {
+    'standard': StandardTime,
+    'ntf':      StandardTime,
+    'log':      StandardTime,
+    'mango':    StandardTime,
+    'vmti':     VMTITime,
+    }
+
+#-- Compression ------------------------------------------------------------
+
+ChunkSize = 1024*1024
+
+# codec: (extension, compressor factory)
+
+Codecs = {
+    'bz2':  ('.bz2', lambda level: bz2.BZ2Compressor(level)),
+    'gzip': ('.gz',  lambda level: zlib.compressobj(level, zlib.DEFLATED, 31)),
+    }
+
+# codec: (program, threads option). These write a single stream.
+# Concatenated streams (pbzip2 or compressing blocks separately)
+# are not used because python2's bz2 module only reads the first.
+
+ParallelTools = {
+    'bz2':  ('lbzip2', '-n'),
+    'gzip': ('pigz', '-p'),
+    }
+
+# Already compressed files are never compressed again, whatever
+# compress.skip says
+
+CompressedExtensions = ['.bz2', '.gz', '.tgz', '.xz', '.zip']
+
+def createCompressor(codec, level):
+    return Codecs[codec][1](level)
+
+def compressStream(src, dst, codec='bz2', level=9):
+
+    # Compress in bounded chunks instead of reading the whole file
+
+    compressor = createCompressor(codec, level)
+
+    while True:
+        chunk = src.read(ChunkSize)
+        if not chunk:
+            break
+        dst.write(compressor.compress(chunk))
+
+    dst.write(compressor.flush())
+
+def compressBlock(data, codec='bz2', level=9):
+    compressor = createCompressor(codec, level)
+    return compressor.compress(data) + compressor.flush()
+
+def findParallelTool(codec):
+
+    if codec not in ParallelTools:
+        return None
+
+    program, option = ParallelTools[codec]
+
+    if not find_executable(program):
+        return None
+
+    return program, option
+
+def compressParallel(src, dst, workers, codec='bz2', level=9):
+
+    # Compress with the codec's multi-threaded program. src and dst
+    # are open files. Returns False if the program is not installed.
+
+    tool = findParallelTool(codec)
+
+    if not tool:
+        return False
+
+    program, option = tool
+    command = [program, option, str(workers), '-%d' % level, '-c']
+
+    process = subprocess.Popen(command, stdin=src, stdout=dst)
+
+    if process.wait():
+        raise IOError('%s exited with %d' % (program, process.returncode))
+
+    return True
+
+class Watcher:
+
+    # Minimal Linux inotify interface (through libc) that watches
+    # directory trees and reports the files that were closed after
+    # writing or moved into place.
+
+    IN_CLOSE_WRITE  = 0x00000008
+    IN_MOVED_TO     = 0x00000080
+    IN_CREATE       = 0x00000100
+    IN_Q_OVERFLOW   = 0x00004000
+    IN_IGNORED      = 0x00008000
+    IN_ISDIR        = 0x40000000
+
+    Mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    EventHeader = struct.Struct('iIII')
+
+    def __init__(self, log):
+
+        self.log = log
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        self.paths = {}
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+
+    def close(self):
+        os.close(self.fd)
+
+    def add(self, path):
+
+        # Watch path and every directory below it
+
+        for dirpath, dirnames, filenames in os.walk(path):
+            wd = self.libc.inotify_add_watch(self.fd, dirpath, self.Mask)
+            if wd < 0:
+                self.log.error('Failed to watch %s: %s' % \
+                    (dirpath, os.strerror(ctypes.get_errno())))
+                continue
+            self.paths[wd] = dirpath
+
+    def read(self, timeout):
+
+        # Return the pathnames of new files, or None if the event
+        # queue overflowed and everything needs to be checked.
+
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+        if not ready:
+            return []
+
+        data = os.read(self.fd, 64*1024)
+        pathnames = []
+        pos = 0
+
+        while pos < len(data):
+
+            wd, mask, cookie, length = self.EventHeader.unpack_from(data, pos)
+            pos += self.EventHeader.size
+            name = data[pos:pos+length].rstrip('\0')
+            pos += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                self.log.info('inotify queue overflow')
+                return None
+
+            if mask & self.IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+
+            if wd not in self.paths or not name:
+                continue
+
+            pathname = os.path.join(self.paths[wd], name)
+
+            if mask & self.IN_ISDIR:
+                # Files may already be in the new directory
+                self.add(pathname)
+                pathnames.extend(self.listFiles(pathname))
+            elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                pathnames.append(pathname)
+
+        return pathnames
+
+    def listFiles(self, path):
+
+        pathnames = []
+
+        for dirpath, dirnames, filenames in os.walk(path):
+            pathnames.extend(os.path.join(dirpath, f) for f in filenames)
+
+        return pathnames
+
 class FileGroup(ConfigComponent, NewsPostMixin):
 
     def __init__(self,name,parent):
@@ -47,20 +534,54 @@ class FileGroup(ConfigComponent, NewsPostMixin):
         self.startPath      = self.get('start.path','.')
         self.matchPaths     = self.getList('match.paths','*')
         self.matchNames     = self.getList('match.names','*')
+        self.matchDepth     = self.getint('match.depth')
+        self.matchTokens    = [patternTokens(path) for path in self.matchPaths]
         self.compress       = self.getboolean('compress',False)
+        self.compressCodec  = self.get('compress.codec','bz2')
+        self.compressLevel  = self.getint('compress.level',9)
+        self.compressMinSize = self.getint('compress.minsize',0)
+        self.compressSkip   = self.getList('compress.skip','*.bz2 *.gz *.xz *.zip *.tgz *.png *.jpg')
+        self.compressProbe  = self.getint('compress.probe',256*1024)
+        self.compressRatio  = self.getfloat('compress.ratio',0.9)
+        self.compressParallel = self.getint('compress.parallel',0)
+        self.compressWorkers = self.getint('compress.workers',multiprocessing.cpu_count())
         self.removeFiles    = self.getboolean('removeFiles',False)
         self.includeLast    = self.getboolean('includeLast',True)
         self.startCurrent   = self.getboolean('startCurrent',False)
         self.maxFiles       = self.getint('maxFiles')
         self.enableParseTime = self.getboolean('parseTime',True)
+        self.timePatternNames = self.getList('parseTime.patterns','standard vmti')
+        self.sortByTime     = self.getboolean('sortByTime',False)
         self.enableSerialNum = self.getboolean('serialNum',False)
+        self.rescanRate     = self.getint('rescan',3600)
+        self.bundle         = self.getboolean('bundle',False)
+        self.bundleCount    = self.getint('bundle.count',50)
+        self.bundleSize     = self.getint('bundle.size',1024*1024)
 
         self.pathRule       = PatternTemplate('path','/')
 
         self.newsgroupTemplate = self.get('post.newsgroup.template')
 
         self.posters        = {}
+        self.lock           = threading.Lock()
         self.timeFilename   = '%s.timestamp' % name
+        self.manifest       = Manifest('%s.manifest' % name)
+        self.lastRescan     = 0
+        self.times          = {}
+        self.timePatterns   = []
+
+        # A custom pattern is tried before the named ones
+
+        if self.get('parseTime.regex'):
+            if not self.get('parseTime.format'):
+                raise ValueError('parseTime.regex needs parseTime.format')
+            self.timePatterns.append(TimePattern(self.get('parseTime.regex'),
+                                                 self.get('parseTime.format')))
+
+        for patternName in self.timePatternNames:
+            if patternName not in TimePatterns:
+                raise ValueError('Unknown parseTime.patterns entry: %s' % patternName)
+            self.timePatterns.append(TimePatterns[patternName])
 
         if not os.path.isfile(self.timeFilename):
             # Default to sometime long ago
@@ -71,156 +592,407 @@ class FileGroup(ConfigComponent, NewsPostMixin):
         if self.startCurrent:
             os.utime(self.timeFilename,None)
 
+        # Files that are not in the manifest and are older than
+        # the timestamp file are considered to be already posted.
+
+        self.since = os.path.getmtime(self.timeFilename)
+
+        if self.compressCodec not in Codecs:
+            raise ValueError('Unknown compress.codec: %s' % self.compressCodec)
+
         self.log.info('Watching for files in %s' % self.startPath)
         self.log.info('   - match paths %s' % ' '.join(self.matchPaths))
         self.log.info('   - match names %s' % ' '.join(self.matchNames))
 
-    def parseTime(self, filename):
-            
-        # Standard format - 20190802-200555C00SEQ01.ntf
-        # Log format - hs-07-20190803-165804.log
-        # VMTI format - vmti_08-02-2019_UTC20-04-55_0000_00.4607
+    def parseTimes(self, pathnames):
 
-        regexs = [
-            ('\d{8}.\d{6}','%Y%m%d-%H%M%S'),
-            ('\d{2}-\d{2}-\d{4}_UTC\d{2}-\d{2}-\d{2}','%m-%d-%Y-UTC%H-%M-%S')
-            ]
+        # Parse the times for a batch of files (pathname: timestamp).
+        # Each pattern is run over the names the earlier ones did not
+        # match. Names without a time are kept as None.
 
-        timestamp = None
+        times = {}
+        remaining = [(pathname, os.path.basename(pathname)) for pathname in pathnames]
 
-        for regex,timefmt in regexs:
-            try:
-                timestr = re.findall(regex,filename)[0]
-                timestr = timestr.replace('_','-')
-                timestamp = datetime.datetime.strptime(timestr,timefmt) 
-                timestamp = timestamp.replace(tzinfo=pytz.utc)
-                break
-            except:
-                pass
+        for pattern in self.timePatterns:
+            missed = []
+            for pathname, filename in remaining:
+                timestamp = pattern.parse(filename)
+                if timestamp:
+                    times[pathname] = timestamp
+                else:
+                    missed.append((pathname, filename))
+            remaining = missed
 
-        if timestamp is None:
+        for pathname, filename in remaining:
             self.log.warn('Unable to parse timestamp from filename: %s' % filename)
+            times[pathname] = None
+
+        return times
+
+    def fileTime(self, pathname):
+
+        # Parsed time from the cache, parsing on a miss
+
+        if pathname not in self.times:
+            self.times.update(self.parseTimes([pathname]))
+
+        return self.times[pathname]
+
+    def timeKey(self, pathname):
 
-        return timestamp
+        # Order by data time. Files without one fall back to mtime.
+
+        timestamp = self.times.get(pathname)
+
+        if timestamp is None:
+            mtime = self.manifest.get(pathname)[0]
+            timestamp = datetime.datetime.fromtimestamp(mtime, pytz.utc)
+
+        return timestamp, pathname
  
-    def post(self, pathname):
+    def getPoster(self, newsgroup):
 
-        if self.enableParseTime:
-            timestamp = self.parseTime(os.path.basename(pathname))
-        else:
-            timestamp = None
+        # Creating a poster changes our config, so one at a time
 
-        newsgroup = self.pathRule(self.newsgroupTemplate,pathname)
-        filesize = os.path.getsize(pathname)
+        with self.lock:
+            if not newsgroup in self.posters:
+                self.put('post.newsgroup',newsgroup)
+                poster = self.createNewsPoster('post')
+                self.posters[newsgroup] = poster
 
-        self.log.info('  - posting %s (%s) to %s' % (pathname,sizeDesc(filesize),newsgroup))
+        return self.posters[newsgroup]
 
-        if not newsgroup in self.posters:
-            self.put('post.newsgroup',newsgroup)
-            poster = self.createNewsPoster('post')
-            self.posters[newsgroup] = poster
+    def post(self, pathnames, newsgroup=None, timestamp=None):
+
+        # Post one or more files as attachments of a single article.
+        # The caller parses the timestamp (see fileTime).
+
+        if isinstance(pathnames, basestring):
+            pathnames = [pathnames]
+
+        if newsgroup is None:
+            newsgroup = self.pathRule(self.newsgroupTemplate,pathnames[0])
+
+        for pathname in pathnames:
+            filesize = os.path.getsize(pathname)
+            self.log.info('  - posting %s (%s) to %s' % (pathname,sizeDesc(filesize),newsgroup))
+
+        poster = self.getPoster(newsgroup)
 
         headers = {}
 
         if self.enableSerialNum:
             headers['X-Transport-SerialNum'] = str(uuid.uuid4())
 
-        self.posters[newsgroup].post([pathname], date=timestamp, headers=headers)
+        poster.post(pathnames, date=timestamp, headers=headers)
+
+    def checkCompress(self, pathname, size):
+
+        # Return the reason for not compressing the file or None
+
+        basename = os.path.basename(pathname)
+        extension = os.path.splitext(basename)[1].lower()
+
+        if extension in CompressedExtensions:
+            return 'already compressed'
+
+        for pattern in self.compressSkip:
+            if fnmatch.fnmatch(basename, pattern):
+                return 'matches %s' % pattern
+
+        if size < self.compressMinSize:
+            return 'smaller than %s' % sizeDesc(self.compressMinSize)
+
+        if self.compressProbe > 0 and size > 0:
 
-    def processFile(self,pathname):
+            # Compress the first block to estimate the ratio
 
-        self.log.info('Processing %s' % pathname)
+            with open(pathname, 'rb') as f:
+                sample = f.read(self.compressProbe)
 
-        bzipext         = '.bz2'
+            ratio = len(compressBlock(sample, self.compressCodec, self.compressLevel))
+            ratio = ratio/float(len(sample))
+
+            if ratio > self.compressRatio:
+                return 'probe ratio %d%%' % (ratio*100)
+
+        return None
+
+    def useParallel(self,size):
+        return self.compressParallel>0 and self.compressWorkers>1 and \
+               size>=self.compressParallel
+
+    def compressFile(self,pathname):
+
+        # Return the file to post and the temporary directory
+        # holding it (None if the original file is posted).
+
+        zipext          = Codecs[self.compressCodec][0]
         basename        = os.path.basename(pathname)
-        baseext         = os.path.splitext(basename)[1]
-        isCompressed    = baseext==bzipext
-        zipname         = basename+bzipext
+        orgsize         = os.path.getsize(pathname)
+
+        if self.compress:
+            reason = self.checkCompress(pathname,orgsize)
+        else:
+            reason = 'disabled'
 
-        if self.compress and not isCompressed:
+        if reason:
+            if self.compress:
+                self.log.info('  - %s not compressed (%s)' % \
+                    (sizeDesc(orgsize),reason))
+            return pathname,None
 
-            self.log.debug('  - compressing file')
-            data = open(pathname).read()
-            open(zipname,'w').write(bz2.compress(data))
+        # Files with the same name can be posted at the same
+        # time for different stations, so use a private dir.
 
-            orgsize = os.path.getsize(pathname)
-            zipsize = os.path.getsize(zipname)
+        zipdir  = tempfile.mkdtemp(prefix='postfiles-',dir='.')
+        zipname = os.path.join(zipdir,basename+zipext)
 
-            if orgsize>0:
-                zippct  = (zipsize/float(orgsize))*100
-            else:
-                zippct  = 0
+        try:
+            self.log.debug('  - compressing file (%s level %d)' % \
+                (self.compressCodec,self.compressLevel))
 
-            self.log.info('  - %s -> %s (%d%%)' % \
-                (sizeDesc(orgsize),sizeDesc(zipsize),zippct))
+            with open(pathname,'rb') as src, open(zipname,'wb') as dst:
+                if not self.useParallel(orgsize) or \
+                   not compressParallel(src,dst,self.compressWorkers,
+                                        self.compressCodec,self.compressLevel):
+                    compressStream(src,dst,self.compressCodec,self.compressLevel)
+        except:
+            shutil.rmtree(zipdir,ignore_errors=True)
+            raise
 
-            postfile = zipname
+        zipsize = os.path.getsize(zipname)
 
+        if orgsize>0:
+            zippct  = (zipsize/float(orgsize))*100
         else:
+            zippct  = 0
 
-            postfile = pathname
+        self.log.info('  - %s -> %s (%d%%)' % \
+            (sizeDesc(orgsize),sizeDesc(zipsize),zippct))
 
-        self.post(postfile)
+        return zipname,zipdir
 
-        # Cleanup files
+    def processFile(self,pathname,newsgroup=None):
+        self.processFiles([pathname],newsgroup)
 
-        removeFile(zipname)
+    def processFiles(self,pathnames,newsgroup=None):
+
+        # Post the files together in a single article. The originals
+        # are only removed after the post has succeeded.
+
+        if newsgroup is None:
+            newsgroup = self.pathRule(self.newsgroupTemplate,pathnames[0])
+
+        postfiles = []
+        zipdirs = []
+
+        try:
+
+            for pathname in pathnames:
+                self.log.info('Processing %s' % pathname)
+                postfile,zipdir = self.compressFile(pathname)
+                postfiles.append(postfile)
+                if zipdir:
+                    zipdirs.append(zipdir)
+
+            if self.enableParseTime:
+                timestamp = self.fileTime(pathnames[0])
+            else:
+                timestamp = None
+
+            self.post(postfiles,newsgroup,timestamp)
+
+        finally:
+
+            # Cleanup files
+
+            for zipdir in zipdirs:
+                shutil.rmtree(zipdir,ignore_errors=True)
 
         if self.removeFiles:
-            removeFile(pathname)
+            for pathname in pathnames:
+                removeFile(pathname)
 
-    def joinList(self, name, parts):
+    def wants(self, pathname):
+        return pathname.startswith(self.startPath) and self.selectFile(pathname)
 
-        result = ['-%s "%s"' % (name, part) for part in parts] 
-        result = ' -o '.join(result)
-        result = '\( %s \)' % result
+    def depth(self, path):
 
-        return result
+        # Number of directories from start.path down to path
 
-    def findFiles(self):
+        relpath = os.path.relpath(path, self.startPath)
+
+        if relpath == '.':
+            return 0
+
+        return relpath.count(os.sep)+1
+
+    def pruneDir(self, path):
+
+        # With match.depth, a directory is also pruned when the
+        # patterns need more directories below it than are allowed
+
+        if self.matchDepth is None:
+            levels = None
+        else:
+            levels = self.matchDepth - self.depth(path)
+            if levels < 0:
+                return True
+
+        return not any(prefixMatch(tokens, path+'/', levels)
+                        for tokens in self.matchTokens)
 
-        names = self.joinList('name', self.matchNames)
-        paths = self.joinList('path', self.matchPaths)
+    def selectFile(self, pathname):
 
-        cmd = 'find %s -newer %s -type f %s %s -print' % \
-            (self.startPath, self.timeFilename, paths,names)
+        filename = os.path.basename(pathname)
 
-        status,output = commands.getstatusoutput(cmd)   # run command, get output
+        if filename.startswith('.'):    # partial file
+            return False
 
-        self.log.debug('cmd=%s' % cmd)
+        if self.matchDepth is not None:
+            if self.depth(os.path.dirname(pathname)) > self.matchDepth:
+                return False
 
-        if status!=0:
+        if not any(fnmatch.fnmatch(filename, name) for name in self.matchNames):
+            return False
+
+        return any(fnmatch.fnmatch(pathname, path) for path in self.matchPaths)
+
+    def findFiles(self):
+
+        full = time.time()-self.lastRescan >= self.rescanRate
+
+        try:
+            filelist = self.manifest.scan(self.startPath,
+                                          self.pruneDir,
+                                          self.selectFile,
+                                          full=full)
+        except OSError:
+            self.log.exception('Failed to scan %s' % self.startPath)
             return []
 
-        filelist = output.split()         # make list, break at \n
-        filelist = [f for f in filelist if not os.path.basename(f).startswith('.')]
-        filelist.sort()
+        if full:
+            self.lastRescan = time.time()
+
+        # Skip files from before the manifest started
+
+        newfiles = []
+
+        for pathname in filelist:
+            mtime, size, posted = self.manifest.get(pathname)
+            if mtime <= self.since:
+                self.manifest.posted(pathname, mtime, size)
+            else:
+                newfiles.append(pathname)
+
+        self.manifest.save()
+
+        # Parse the filename times once for the whole batch
+
+        if self.enableParseTime or self.sortByTime:
+            self.times = self.parseTimes(newfiles)
+        else:
+            self.times = {}
+
+        if self.sortByTime:
+            filelist = sorted(newfiles, key=self.timeKey)
+        else:
+            filelist = sorted(newfiles)
 
         if not self.includeLast:
             filelist = filelist[0:-1]       # don't include the current file
 
         if self.maxFiles:                   # keep only the last N files
 
-            if self.removeFiles:
-                removeFiles(filelist[:-maxFiles])
+            for pathname in filelist[:-self.maxFiles]:
+                if self.removeFiles:
+                    removeFile(pathname)
+                    self.manifest.remove(pathname)
+                else:
+                    mtime, size, posted = self.manifest.get(pathname)
+                    self.manifest.posted(pathname, mtime, size)
+
+            self.manifest.save()
 
             filelist = filelist[-self.maxFiles:]
 
         return filelist
 
-    def process(self):
+    def findBatches(self):
+
+        # Group the new files by their destination newsgroup,
+        # keeping the file order within each newsgroup.
 
-        pathnames = self.findFiles()
-        self.log.debug('Polling - found %d new files.' % len(pathnames))
+        batches = OrderedDict()
+
+        for pathname in self.findFiles():
+            newsgroup = self.pathRule(self.newsgroupTemplate,pathname)
+            batches.setdefault(newsgroup,[]).append(pathname)
+
+        return batches
+
+    def makeBundles(self, pathnames):
+
+        # Split the files into groups of at most bundleCount files
+        # and bundleSize bytes. Larger files are posted by themselves.
+
+        if not self.bundle:
+            return [[pathname] for pathname in pathnames]
+
+        bundles = []
+        current = []
+        total = 0
 
         for pathname in pathnames:
 
+            size = self.manifest.get(pathname)[1]
+
+            if current and (len(current) >= self.bundleCount or
+                            total+size > self.bundleSize):
+                bundles.append(current)
+                current = []
+                total = 0
+
+            current.append(pathname)
+            total += size
+
+        if current:
+            bundles.append(current)
+
+        return bundles
+
+    def postFiles(self, newsgroup, pathnames):
+
+        # Post in order and stop at the first failure, so later
+        # files are not marked as posted ahead of an earlier one.
+
+        for bundle in self.makeBundles(pathnames):
+
             if not self.running:
                 break 
 
-            timestamp=os.path.getmtime(pathname)
-            self.processFile(pathname)
-            os.utime(self.timeFilename,(timestamp,timestamp))
+            records = [self.manifest.get(pathname) for pathname in bundle]
+
+            self.processFiles(bundle,newsgroup)
+
+            with self.lock:
+                for pathname,(mtime,size,posted) in zip(bundle,records):
+                    if self.removeFiles:
+                        self.manifest.remove(pathname)
+                    else:
+                        self.manifest.posted(pathname, mtime, size)
+
+                self.manifest.save()
+
+    def process(self):
+
+        batches = self.findBatches()
+        count = sum(len(pathnames) for pathnames in batches.values())
+        self.log.debug('Polling - found %d new files.' % count)
+
+        for newsgroup, pathnames in batches.items():
+            self.postFiles(newsgroup, pathnames)
 
 class PostFiles(ProcessClient):
 
@@ -229,20 +1001,29 @@ class PostFiles(ProcessClient):
 
         self.pollrate = self.getRate('pollrate', '5:00')
         self.exitOnError = self.getboolean('exitOnError', False)
+        self.enableWatch = self.getboolean('watch', False)
+        self.watchDelay = self.getfloat('watch.delay', 0.2)
+        self.postWorkers = self.getint('post.workers', 1)
 
         self.filegroups = self.getComponentsList('filegroups', FileGroup)
 
+        # Serialize the poll and watch threads
+
+        self.lock = threading.Lock()
+
     def preprocess(self):
         return
 
     def postprocess(self):
         return
 
-    def process(self):
+    def processGroups(self, filegroups):
 
-        self.preprocess()
+        if self.postWorkers > 1:
+            self.processConcurrent(filegroups)
+            return
 
-        for filegroup in self.filegroups:
+        for filegroup in filegroups:
             try:
                 filegroup.process()
             except SystemExit:
@@ -255,10 +1036,129 @@ class PostFiles(ProcessClient):
             if not self.running:
                 break
 
-        self.postprocess()
+    def processConcurrent(self, filegroups):
+
+        # Post to different newsgroups in parallel. Each newsgroup
+        # is handled by a single worker so its order is kept.
+
+        tasks = Queue.Queue()
+
+        for filegroup in filegroups:
+            try:
+                batches = filegroup.findBatches()
+            except:
+                self.log.exception('Problem processing filegroup %s' % filegroup.name)
+                if self.exitOnError:
+                    self.running = False
+                    return
+                continue
+
+            for newsgroup, pathnames in batches.items():
+                tasks.put((filegroup, newsgroup, pathnames))
+
+        workers = []
+
+        for k in range(min(self.postWorkers, tasks.qsize())):
+            worker = threading.Thread(target=self.postWorker, args=(tasks,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        for worker in workers:
+            worker.join()
+
+    def postWorker(self, tasks):
+
+        while self.running:
+
+            try:
+                filegroup, newsgroup, pathnames = tasks.get_nowait()
+            except Queue.Empty:
+                break
+
+            try:
+                filegroup.postFiles(newsgroup, pathnames)
+            except SystemExit:
+                self.running = False
+            except:
+                self.log.exception('Problem posting to %s' % newsgroup)
+                if self.exitOnError:
+                    self.running = False
+
+    def process(self):
+
+        with self.lock:
+            self.preprocess()
+            self.processGroups(self.filegroups)
+            self.postprocess()
+
+    def startWatch(self):
+
+        # Process new files as soon as they are written. The regular
+        # polling keeps running as a safety net.
+
+        self.watcher = Watcher(self.log)
+
+        for path in set(filegroup.startPath for filegroup in self.filegroups):
+            self.log.info('Watching %s for new files' % path)
+            self.watcher.add(path)
+
+        thread = threading.Thread(target=self.watch)
+        thread.daemon = True
+        thread.start()
+
+    def watch(self):
+
+        while self.running:
+
+            try:
+                pathnames = self.watcher.read(1)
+
+                if pathnames == []:
+                    continue
+
+                # Collect the rest of a burst of events
+
+                while pathnames is not None:
+                    more = self.watcher.read(self.watchDelay)
+                    if more is None:
+                        pathnames = None
+                    elif more:
+                        pathnames.extend(more)
+                        continue
+                    break
+
+                if pathnames is None:
+                    filegroups = self.filegroups
+                else:
+                    filegroups = [filegroup for filegroup in self.filegroups
+                                  if any(filegroup.wants(p) for p in pathnames)]
+
+                if not filegroups:
+                    continue
+
+                with self.lock:
+
+                    # Files rewritten in place do not change the mtime
+                    # of their directory, so have the manifest list it.
+                    # The poll thread scans the manifest under the lock.
+
+                    for filegroup in filegroups:
+                        for pathname in pathnames or []:
+                            filegroup.manifest.invalidate(os.path.dirname(pathname))
+
+                    self.processGroups(filegroups)
+
+            except:
+                self.log.exception('Problem in watcher')
+                if self.exitOnError:
+                    self.running = False
 
     def run(self):
 
+        if self.enableWatch:
+            self.startWatch()
+
         while self.wait(self.pollrate):
             try:
                 self.process()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python2
+
+#########################################################
+#
+#   Benchmark the Artemis record reader and writers
+#
+#   Generates synthetic records (artemis_synth) and times
+#   read, header only read, Snapshot parsing, write_hdf5
+#   and write_png. Each stage runs in its own process so
+#   the peak memory is per stage. Results are written as
+#   JSON for comparing runs between commits:
+#
+#   MB/s is always the decompressed record bytes per second.
+#   The read stages also report the compressed file bytes
+#   per second (file MB/s). The peak is the process high
+#   water mark, which includes the records loaded for the
+#   parse and write stages. The delta (+) is the growth
+#   during the timed part only.
+#
+#       benchmark_artemis.py -o before.json
+#       (change code)
+#       benchmark_artemis.py -o after.json -c before.json
+#
+#   2026-10-17  Todd Valentic
+#               Initial implementation
+#
+#   2026-10-17  Todd Valentic
+#               Keep the input loading out of the peak delta,
+#               report record and file MB/s separately
+#
+#########################################################
+
+import os
+import json
+import time
+import shutil
+import socket
+import platform
+import optparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+import numpy as np
+
+import artemis_data
+import artemis_synth
+
+Stages = ['read', 'read_header', 'parse', 'write_hdf5', 'write_png']
+
+def maxrss():
+    # Peak resident size (KB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def loadRecords(filenames):
+    return [str(artemis_data.read_record(filename)) for filename in filenames]
+
+def loadStage(stage, filenames, workdir):
+
+    # Returns the inputs for the stage (loaded before timing)
+    # and the function that is timed on each of them
+
+    if stage == 'read':
+        return filenames, artemis_data.read
+
+    if stage == 'read_header':
+        return filenames, lambda f: artemis_data.read(f, metadata_only=True)
+
+    records = loadRecords(filenames)
+
+    if stage == 'parse':
+        return records, artemis_data.Snapshot
+
+    snapshots = [artemis_data.Snapshot(record) for record in records]
+    output = os.path.join(workdir, 'output')
+
+    return snapshots, lambda snapshot: getattr(snapshot, stage)(output)
+
+def runStage(stage, filenames, workdir):
+
+    # Returns (seconds, peak before and after the timed part)
+
+    items, function = loadStage(stage, filenames, workdir)
+
+    baseline = maxrss()
+    start = time.time()
+
+    for item in items:
+        function(item)
+
+    return time.time()-start, baseline, maxrss()
+
+def stageWorker(stage, filenames, workdir, results):
+
+    try:
+        seconds, baseline, peak = runStage(stage, filenames, workdir)
+        results.put((seconds, baseline, peak, None))
+    except Exception as e:
+        results.put((0, 0, maxrss(), '%s: %s' % (type(e).__name__, e)))
+
+def measure(stage, filenames, workdir):
+
+    results = multiprocessing.Queue()
+
+    process = multiprocessing.Process(target=stageWorker,
+                                      args=(stage, filenames, workdir, results))
+    process.start()
+    result = results.get()
+    process.join()
+
+    return result
+
+def gitCommit():
+
+    path = os.path.dirname(os.path.abspath(__file__))
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                             cwd=path, stderr=devnull)
+        return output.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark(options, workdir):
+
+    results = []
+
+    for version in options.versions:
+
+        path = os.path.join(workdir, 'v%d' % version)
+
+        filenames = artemis_synth.generate(path,
+                        count=options.count,
+                        compress=options.compress,
+                        version=version,
+                        width=options.width,
+                        height=options.height,
+                        bin_x=options.binning,
+                        bin_y=options.binning,
+                        bytes_per_pixel=options.bytes_per_pixel)
+
+        fileBytes = sum(os.path.getsize(f) for f in filenames)
+        recordBytes = sum(len(artemis_data.read_record(f)) for f in filenames)
+
+        for stage in options.stages:
+
+            timings = []
+
+            for k in range(options.repeat):
+                seconds, baseline, peak, error = measure(stage, filenames, workdir)
+                if error:
+                    break
+                timings.append(seconds)
+
+            result = dict(stage=stage, version=version, files=len(filenames))
+
+            if error:
+                result['error'] = error
+            else:
+                seconds = max(min(timings), 1e-9)
+                result.update(
+                    record_bytes=recordBytes,
+                    file_bytes=fileBytes,
+                    seconds=seconds,
+                    timings=timings,
+                    files_per_sec=len(filenames)/seconds,
+                    mb_per_sec=recordBytes/seconds/1e6,
+                    peak_rss_kb=peak,
+                    peak_delta_kb=peak-baseline)
+                if stage.startswith('read'):
+                    result['file_mb_per_sec'] = fileBytes/seconds/1e6
+
+            report(result)
+            results.append(result)
+
+        shutil.rmtree(path, ignore_errors=True)
+
+    return results
+
+def report(result, previous=None):
+
+    if 'error' in result:
+        print('v%d %-12s FAILED %s' % (result['version'], result['stage'], result['error']))
+        return
+
+    line = 'v%d %-12s %8.1f files/s %8.1f MB/s  peak %7d KB (+%d)' % \
+        (result['version'], result['stage'], result['files_per_sec'],
+         result['mb_per_sec'], result['peak_rss_kb'], result['peak_delta_kb'])
+
+    if 'file_mb_per_sec' in result:
+        line += '  file %.1f MB/s' % result['file_mb_per_sec']
+
+    if previous and previous.get('files_per_sec'):
+        line += '  %+.1f%%' % (100.0*(result['files_per_sec']/previous['files_per_sec']-1))
+
+    print(line)
+
+def compare(results, filename):
+
+    with open(filename) as f:
+        baseline = json.load(f)
+
+    previous = dict(((r['stage'], r['version']), r) for r in baseline['results'])
+
+    print('Compared to %s (%s)' % (filename, baseline.get('commit')))
+
+    for result in results:
+        report(result, previous.get((result['stage'], result['version'])))
+
+if __name__ == '__main__':
+
+    usage = '%prog [options]'
+
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option('-n','--count',dest='count',type='int',default=20,
+                        help='Number of records per version [%default]')
+    parser.add_option('-v','--versions',dest='versions',default='1,2,3',
+                        help='Record versions [%default]')
+    parser.add_option('-W','--width',dest='width',type='int',default=1024,
+                        help='Sensor width [%default]')
+    parser.add_option('-H','--height',dest='height',type='int',default=1024,
+                        help='Sensor height [%default]')
+    parser.add_option('-b','--bin',dest='binning',type='int',default=1,
+                        help='Binning in x and y [%default]')
+    parser.add_option('-B','--bytes',dest='bytes_per_pixel',type='int',default=2,
+                        help='Bytes per pixel (1,2,4) [%default]')
+    parser.add_option('--no-bz2',dest='compress',action='store_false',default=True,
+                        help='Do not compress the records')
+    parser.add_option('-s','--stages',dest='stages',default=','.join(Stages),
+                        help='Stages to run [%default]')
+    parser.add_option('-r','--repeat',dest='repeat',type='int',default=3,
+                        help='Runs per stage, the fastest is kept [%default]')
+    parser.add_option('-o','--output',dest='output',
+                        help='Write the results to this JSON file')
+    parser.add_option('-c','--compare',dest='compare',
+                        help='Compare with the results in this JSON file')
+    parser.add_option('-d','--workdir',dest='workdir',
+                        help='Directory for the test files (default temporary)')
+
+    (options, args) = parser.parse_args()
+
+    options.versions = [int(v) for v in options.versions.split(',')]
+    options.stages = options.stages.split(',')
+
+    for stage in options.stages:
+        if stage not in Stages:
+            parser.error('Unknown stage: %s' % stage)
+
+    workdir = tempfile.mkdtemp(prefix='artemis-bench-', dir=options.workdir)
+
+    try:
+        results = benchmark(options, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if options.compare:
+        compare(results, options.compare)
+
+    if options.output:
+
+        output = dict(
+            timestamp=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            commit=gitCommit(),
+            host=socket.gethostname(),
+            platform=platform.platform(),
+            python=platform.python_version(),
+            numpy=np.__version__,
+            cpus=multiprocessing.cpu_count(),
+            config=dict(count=options.count,
+                        width=options.width,
+                        height=options.height,
+                        binning=options.binning,
+                        bytes_per_pixel=options.bytes_per_pixel,
+                        compress=options.compress,
+                        repeat=options.repeat),
+            results=results)
+
+        with open(options.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
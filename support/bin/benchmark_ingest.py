@@ -0,0 +1,285 @@
+#!/usr/bin/env python2
+
+#########################################################
+#
+#   Benchmark the database ingest (artemis_store.Store)
+#
+#   Starts a throwaway PostgreSQL cluster in a temporary
+#   directory (initdb and pg_ctl need to be on the PATH
+#   or given with --pgbin, and cannot run as root), or
+#   uses an existing scratch database given with --uri.
+#   The tables are created and the dimension tables are
+#   seeded from the same files as setup-test-db.sh. Then
+#   N synthetic snapshots are replayed through the store
+#   for each batch size, reporting rows/s, queries per
+#   row and the commit latency:
+#
+#       benchmark_ingest.py -n 5000 -b 0,100 -o run.json
+#
+#   PostgreSQL is used rather than SQLite because the
+#   image table is partitioned and the batched writes are
+#   postgres upserts, which SQLite cannot stand in for.
+#
+#   2026-10-17  Todd Valentic
+#               Initial implementation
+#
+#########################################################
+
+import os
+import json
+import time
+import shutil
+import socket
+import logging
+import optparse
+import tempfile
+import subprocess
+
+from sqlalchemy import event, text
+
+import metrics
+import artemis_data
+import artemis_synth
+import model
+
+BinPath = os.path.dirname(os.path.abspath(__file__))
+
+# Same order as setup-test-db.sh
+
+SeedFiles = [
+    'status.conf',
+    'device.conf',
+    'instrument.conf',
+    'system_model.conf',
+    'station.conf',
+    'fusionproducts.conf',
+    'processed_products.conf',
+    'stationinstrument.conf',
+    'statisticproducts.conf',
+    ]
+
+class ScratchCluster:
+
+    # PostgreSQL cluster in a temporary directory, only reachable
+    # through a unix socket in that directory.
+
+    def __init__(self, pgbin=None, fsync=True, port=5432):
+
+        self.pgbin = pgbin
+        self.path = tempfile.mkdtemp(prefix='mango-bench-')
+        self.data = os.path.join(self.path, 'data')
+        self.port = port
+
+        self.run('initdb', '-D', self.data, '-A', 'trust', '-U', 'postgres',
+                 '-E', 'UTF8', '--nosync')
+
+        settings = "-k %s -p %d -c listen_addresses='' -c fsync=%s" % \
+                    (self.path, port, 'on' if fsync else 'off')
+
+        self.run('pg_ctl', '-D', self.data, '-w', '-o', settings,
+                 '-l', os.path.join(self.path, 'postgres.log'), 'start')
+
+        self.uri = 'postgresql://postgres@/postgres?host=%s&port=%d' % \
+                    (self.path, port)
+
+    def command(self, name):
+        if self.pgbin:
+            return os.path.join(self.pgbin, name)
+        return name
+
+    def run(self, name, *args):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([self.command(name)]+list(args), stdout=devnull)
+
+    def stop(self):
+        try:
+            self.run('pg_ctl', '-D', self.data, '-m', 'fast', 'stop')
+        finally:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+def seed():
+
+    # Run update.py on the setup files (includes are relative)
+
+    import update
+
+    cwd = os.getcwd()
+    os.chdir(BinPath)
+
+    try:
+        for filename in SeedFiles:
+            update.Reload(filename, None)
+    finally:
+        os.chdir(cwd)
+
+def makeSnapshots(count):
+
+    # Header only snapshots for an existing station/instrument/device
+
+    stationinstrument = model.StationInstrument.query.first()
+    device = model.Device.query.first()
+
+    metadata = artemis_synth.make_metadata(
+                    width=16, height=16,
+                    start_time=time.time()-count*120,
+                    station=stationinstrument.station.name,
+                    instrument=stationinstrument.instrument.name,
+                    device_name=device.name)
+
+    pixels = artemis_synth.make_pixels(metadata)
+    snapshots = []
+
+    for k in range(count):
+        record = dict(metadata, start_time=metadata['start_time']+k*120)
+        rawdata = artemis_synth.pack_record(record, pixels)
+        snapshots.append(artemis_data.Snapshot(rawdata, metadata_only=True))
+
+    return snapshots
+
+def stageStats(registry, stage):
+
+    hist = None
+
+    for (name, labels), value in registry.histograms.items():
+        if name != stage:
+            continue
+        if hist:
+            hist.merge(value)
+        else:
+            hist = value.copy()
+
+    if not hist or not hist.count:
+        return dict(count=0)
+
+    return dict(count=hist.count,
+                total=hist.sum,
+                mean_ms=1000*hist.sum/hist.count,
+                p95_ms=1000*hist.quantile(0.95))
+
+def replay(snapshots, batchSize, cache):
+
+    import artemis_store
+
+    model.execute(text('truncate image'))
+    model.commit()
+
+    store = artemis_store.Store(exitOnError=True, batchSize=batchSize)
+    store.filename = 'benchmark'
+
+    if not cache:
+        store.setCache([])
+
+    queries = [0]
+
+    def countQuery(*pos, **kw):
+        queries[0] += 1
+
+    engine = model.get_engine()
+    event.listen(engine, 'before_cursor_execute', countQuery)
+
+    metrics.registry = metrics.Registry()
+
+    try:
+        start = time.time()
+        for snapshot in snapshots:
+            store.updateRecord(snapshot)
+        store.flush()
+        elapsed = max(time.time()-start, 1e-9)
+    finally:
+        event.remove(engine, 'before_cursor_execute', countQuery)
+
+    rows = model.Image.query.count()
+
+    return dict(batch_size=batchSize,
+                cache=cache,
+                rows=rows,
+                seconds=elapsed,
+                rows_per_sec=len(snapshots)/elapsed,
+                queries=queries[0],
+                queries_per_row=float(queries[0])/len(snapshots),
+                commit=stageStats(metrics.registry, 'commit'),
+                update=stageStats(metrics.registry, 'update'),
+                lookup=stageStats(metrics.registry, 'lookup'))
+
+def report(result):
+
+    print('batch %-5d cache %-3s %8.1f rows/s %6.2f queries/row  '
+          'commit %.2fms (p95<=%gms, n=%d)' % \
+        (result['batch_size'], 'on' if result['cache'] else 'off',
+         result['rows_per_sec'], result['queries_per_row'],
+         result['commit'].get('mean_ms', 0), result['commit'].get('p95_ms', 0),
+         result['commit']['count']))
+
+if __name__ == '__main__':
+
+    usage = '%prog [options]'
+
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option('-n','--count',dest='count',type='int',default=2000,
+                        help='Number of snapshots [%default]')
+    parser.add_option('-b','--batch',dest='batch',default='0,100',
+                        help='Batch sizes to run (0 is per row) [%default]')
+    parser.add_option('--no-cache',dest='cache',action='store_false',default=True,
+                        help='Do not cache the lookup tables')
+    parser.add_option('-u','--uri',dest='uri',
+                        help='Use this scratch database (tables are created)')
+    parser.add_option('--pgbin',dest='pgbin',
+                        help='Directory with initdb and pg_ctl')
+    parser.add_option('--no-fsync',dest='fsync',action='store_false',default=True,
+                        help='Run the scratch cluster with fsync off')
+    parser.add_option('-o','--output',dest='output',
+                        help='Write the results to this JSON file')
+    parser.add_option('-v','--verbose',dest='verbose',action='store_true',default=False,
+                        help='Log each row')
+
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if options.verbose else logging.WARNING)
+
+    if options.uri:
+        cluster = None
+        uri = options.uri
+    else:
+        cluster = ScratchCluster(options.pgbin, options.fsync)
+        uri = cluster.uri
+
+    model.configure(uri)
+
+    results = []
+
+    try:
+        model.create()
+
+        # Each run truncates the image table
+
+        if options.uri and model.Image.query.count():
+            parser.error('The image table in %s is not empty' % uri)
+
+        seed()
+
+        snapshots = makeSnapshots(options.count)
+
+        for batchSize in [int(size) for size in options.batch.split(',')]:
+            result = replay(snapshots, batchSize, options.cache)
+            report(result)
+            results.append(result)
+
+    finally:
+        model.remove()
+        model.get_engine().dispose()
+        if cluster:
+            cluster.stop()
+
+    if options.output:
+
+        output = dict(
+            timestamp=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            host=socket.gethostname(),
+            count=options.count,
+            fsync=options.fsync,
+            scratch=cluster is not None,
+            results=results)
+
+        with open(options.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
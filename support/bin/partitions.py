@@ -0,0 +1,72 @@
+#!/usr/bin/env python2
+
+#########################################################
+#
+#   Manage the monthly image table partitions
+#
+#   Run from cron to keep partitions created ahead of
+#   the incoming data and to detach old months.
+#
+#   2026-10-17  Todd Valentic
+#               Initial implementation
+#
+#   2026-10-17  Todd Valentic
+#               Add --end, create every month from --start
+#
+#########################################################
+
+import sys
+import optparse
+import datetime
+import logging
+
+import model
+
+logging.basicConfig(level=logging.INFO)
+
+def parseDate(value):
+    return datetime.datetime.strptime(value,'%Y-%m')
+
+if __name__ == '__main__':
+
+    usage = '%prog [options]'
+
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option('-s','--start',dest='start',metavar='YYYY-MM',
+                        help='First month to create (default current)')
+    parser.add_option('-e','--end',dest='end',metavar='YYYY-MM',
+                        help='Last month before those ahead (default current)')
+    parser.add_option('-a','--ahead',dest='ahead',type='int',default=3,
+                        help='Number of months to create ahead [%default]')
+    parser.add_option('-d','--detach',dest='detach',metavar='YYYY-MM',
+                        help='Detach partitions before this month')
+    parser.add_option('--drop',dest='drop',action='store_true',default=False,
+                        help='Drop the detached partitions')
+    parser.add_option('-l','--list',dest='list',action='store_true',default=False,
+                        help='List the current partitions')
+
+    options,args = parser.parse_args()
+
+    try:
+        start = parseDate(options.start) if options.start else None
+        end = parseDate(options.end) if options.end else None
+
+        for name in model.create_partitions(start,options.ahead,end=end):
+            logging.info('Created partition %s' % name)
+
+        if options.detach:
+            before = parseDate(options.detach)
+            for name in model.detach_partitions(before,drop=options.drop):
+                logging.info('Detached %s' % name)
+
+        if options.list:
+            for name in model.list_partitions():
+                print(name)
+
+    except:
+        model.rollback()
+        logging.exception('Failed to update partitions')
+        sys.exit(1)
+
+    sys.exit(0)
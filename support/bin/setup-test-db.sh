@@ -33,4 +33,5 @@ export MANGO_DATABASE_URI=postgresql://@/mango-test
 ./update.py processed_products.conf
 ./update.py stationinstrument.conf
 ./update.py statisticproducts.conf
+./partitions.py
 
@@ -0,0 +1,390 @@
+#!/usr/bin/env python2
+
+##########################################################################
+#
+#   Per-night HDF5 image cubes for Artemis snapshots
+#
+#   Appends the snapshots from one station and instrument into a
+#   single file per night instead of one file per frame:
+#
+#       /image              (time, height, width), one chunk per frame
+#       /metadata/<field>   one column per metadata field, same length
+#       /units              attributes with the metadata units
+#
+#   The metadata columns are indexed by start_time. Frames that are
+#   already in the file (same start_time) are skipped, so a file can
+#   be safely appended to again after a restart.
+#
+#   The start_time column is always extended last. When a file is
+#   reopened, every dataset is cut back to its length, which drops a
+#   frame that was only partly written when the writer stopped.
+#
+#   Files use the default (earliest) HDF5 format. The newer format
+#   marks a file as open for write and refuses to reopen it after the
+#   writer dies without closing it. Such files (made before this was
+#   changed) are cleared with h5clear if it is installed.
+#
+#   Check the unclean shutdown handling with:
+#
+#       artemis_cube.py --check
+#
+#   2026-10-17  Todd Valentic
+#               Initial implementation
+#
+#   2026-10-17  Todd Valentic
+#               Reopen files after an unclean shutdown
+#
+##########################################################################
+
+import os
+import datetime
+import subprocess
+import h5py
+import numpy as np
+
+from artemis_data import UnitsCatalog, as_native
+
+IndexField = 'start_time'
+
+# HDF5 filters for the image dataset
+
+Compressions = {
+    'gzip':     lambda level: dict(compression='gzip', compression_opts=level),
+    'lzf':      lambda level: dict(compression='lzf'),
+    'none':     lambda level: dict(),
+    }
+
+StringSize = 64
+
+def column_dtype(value):
+
+    if isinstance(value, (bytes, str)):
+        return np.dtype('S%d' % StringSize)
+
+    if isinstance(value, (bool, np.bool_)):
+        return np.dtype('u1')
+
+    if isinstance(value, (int, long, np.integer)):
+        return np.dtype('i8')
+
+    return np.dtype('f8')
+
+def filter_options(compression='gzip', level=4, shuffle=True, scaleoffset=None):
+
+    if compression not in Compressions:
+        raise ValueError('Unknown compression: %s' % compression)
+
+    options = Compressions[compression](level)
+
+    if shuffle and compression != 'none':
+        options['shuffle'] = True
+
+    if scaleoffset is not None:
+        options['scaleoffset'] = scaleoffset
+
+    return options
+
+class ImageCube:
+
+    def __init__(self, filename, flush=True, **kw):
+
+        # kw are the filter options (see filter_options). They
+        # only apply when the file is created.
+
+        self.filename = filename
+        self.filters = filter_options(**kw)
+        self.autoflush = flush
+
+        if os.path.exists(filename):
+            self.output = self.reopen(filename)
+            self.recover()
+        else:
+            path = os.path.dirname(filename)
+            if path and not os.path.isdir(path):
+                os.makedirs(path)
+            self.output = h5py.File(filename, 'w')
+
+        self.times = set(self.start_times())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        if 'image' not in self.output:
+            return 0
+        return self.output['image'].shape[0]
+
+    def reopen(self, filename):
+
+        try:
+            return h5py.File(filename, 'a')
+        except EnvironmentError:
+            # Left flagged as open for write by a writer that died
+            if not clear_flags(filename):
+                raise
+
+        return h5py.File(filename, 'a')
+
+    def datasets(self):
+
+        if 'image' not in self.output:
+            return []
+
+        return [self.output['image']] + list(self.output['metadata'].values())
+
+    def recover(self):
+
+        # Cut every dataset back to the number of complete frames
+
+        datasets = self.datasets()
+
+        if not datasets:
+            return
+
+        count = min(dataset.shape[0] for dataset in datasets)
+
+        for dataset in datasets:
+            if dataset.shape[0] != count:
+                dataset.resize(count, axis=0)
+
+        self.output.flush()
+
+    def start_times(self):
+
+        if 'metadata' not in self.output:
+            return []
+
+        return self.output['metadata'][IndexField][:]
+
+    def create(self, snapshot):
+
+        height, width = snapshot.pixels.shape
+        dtype = as_native(snapshot.pixels).dtype
+
+        self.output.attrs['version'] = 2
+
+        for key in ('station', 'instrument', 'device_name'):
+            self.output.attrs[key] = snapshot.metadata.get(key, '')
+
+        self.output.create_dataset('image',
+                                   shape=(0, height, width),
+                                   maxshape=(None, height, width),
+                                   chunks=(1, height, width),
+                                   dtype=dtype,
+                                   **self.filters)
+
+        metadata = self.output.create_group('metadata')
+
+        for key, value in sorted(snapshot.metadata.items()):
+            metadata.create_dataset(key,
+                                    shape=(0,),
+                                    maxshape=(None,),
+                                    chunks=(1024,),
+                                    dtype=column_dtype(value))
+
+        units = self.output.create_group('units')
+        units.attrs.update(UnitsCatalog)
+
+    def append(self, snapshot):
+
+        # Returns False if the frame is already in the file
+
+        start_time = snapshot.metadata[IndexField]
+
+        if start_time in self.times:
+            return False
+
+        if 'image' not in self.output:
+            self.create(snapshot)
+
+        image = self.output['image']
+        metadata = self.output['metadata']
+
+        if snapshot.pixels.shape != image.shape[1:]:
+            raise ValueError('Frame size %s does not match %s in %s' % \
+                (snapshot.pixels.shape, image.shape[1:], self.filename))
+
+        index = image.shape[0]
+
+        image.resize(index+1, axis=0)
+        image[index] = as_native(snapshot.pixels)
+
+        fields = [key for key in metadata if key != IndexField] + [IndexField]
+
+        for key in fields:
+            column = metadata[key]
+            column.resize(index+1, axis=0)
+            column[index] = snapshot.metadata.get(key, column.dtype.type())
+
+        self.times.add(start_time)
+
+        if self.autoflush:
+            self.output.flush()
+
+        return True
+
+    def find(self, start_time):
+
+        # Frame index for start_time or None
+
+        times = self.start_times()
+        index = np.flatnonzero(times == start_time)
+
+        if not len(index):
+            return None
+
+        return int(index[0])
+
+    def flush(self):
+        self.output.flush()
+
+    def close(self):
+        if self.output:
+            self.output.close()
+            self.output = None
+
+def clear_flags(filename):
+
+    # Clear the file consistency flags (h5clear is in the HDF5 tools)
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(['h5clear', '-s', filename],
+                                   stdout=devnull, stderr=devnull) == 0
+    except OSError:
+        return False
+
+def check_reopen(path, frames=3):
+
+    # Append frames in a child process that exits without closing
+    # the file, then reopen it here. Returns the number of frames.
+
+    import artemis_data
+    import artemis_synth
+
+    filename = os.path.join(path, 'check-reopen.h5')
+
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    metadata = artemis_synth.make_metadata(width=64, height=64)
+    pixels = artemis_synth.make_pixels(metadata)
+
+    pid = os.fork()
+
+    if pid == 0:
+        cube = ImageCube(filename)
+        for k in range(frames):
+            record = dict(metadata, start_time=metadata['start_time']+k)
+            rawdata = artemis_synth.pack_record(record, pixels)
+            cube.append(artemis_data.Snapshot(rawdata))
+        os._exit(0)
+
+    os.waitpid(pid, 0)
+
+    try:
+        with ImageCube(filename) as cube:
+            return len(cube)
+    finally:
+        os.remove(filename)
+
+def night_of(start_time, offset=0):
+
+    # Night (date) of a unix time. offset (hours) is added before
+    # taking the UTC date, so the night starts at 24-offset UTC.
+
+    timestamp = datetime.datetime.utcfromtimestamp(start_time + offset*3600)
+
+    return timestamp.strftime('%Y%m%d')
+
+class CubeSet:
+
+    # One open cube per station/instrument. A cube is closed when
+    # a frame for another night arrives.
+
+    Template = '%(station)s/%(instrument)s/%(station)s-%(instrument)s-%(night)s.h5'
+
+    def __init__(self, path, template=Template, offset=0, **kw):
+        self.path = path
+        self.template = template
+        self.offset = offset
+        self.options = kw
+        self.cubes = {}
+
+    def filename(self, station, instrument, night):
+        values = dict(station=station, instrument=instrument, night=night)
+        return os.path.join(self.path, self.template % values)
+
+    def append(self, snapshot):
+
+        metadata = snapshot.metadata
+        station = metadata['station']
+        instrument = metadata['instrument'] or 'unknown'
+        night = night_of(metadata[IndexField], self.offset)
+
+        key = (station, instrument)
+
+        if key in self.cubes and self.cubes[key][0] != night:
+            self.cubes.pop(key)[1].close()
+
+        if key not in self.cubes:
+            filename = self.filename(station, instrument, night)
+            self.cubes[key] = (night, ImageCube(filename, **self.options))
+
+        return self.cubes[key][1].append(snapshot)
+
+    def flush(self):
+        for night, cube in self.cubes.values():
+            cube.flush()
+
+    def close(self):
+        for night, cube in self.cubes.values():
+            cube.close()
+        self.cubes = {}
+
+if __name__ == '__main__':
+
+    import sys
+    import optparse
+    import artemis_data
+
+    usage = '%prog [options] filename...'
+
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option('-o','--output',dest='output',default='.',
+                        help='Output path [%default]')
+    parser.add_option('-c','--compression',dest='compression',default='gzip',
+                        help='gzip, lzf or none [%default]')
+    parser.add_option('-l','--level',dest='level',type='int',default=4,
+                        help='gzip level [%default]')
+    parser.add_option('--no-shuffle',dest='shuffle',action='store_false',default=True,
+                        help='Do not use the shuffle filter')
+    parser.add_option('-s','--scaleoffset',dest='scaleoffset',type='int',
+                        help='Scale-offset filter bits (0 is automatic)')
+    parser.add_option('--check',dest='check',action='store_true',default=False,
+                        help='Check reopening a file after an unclean shutdown')
+
+    (options, args) = parser.parse_args()
+
+    if options.check:
+        count = check_reopen(options.output)
+        print('Reopened after unclean shutdown: %d of 3 frames' % count)
+        sys.exit(0 if count == 3 else 1)
+
+    cubes = CubeSet(options.output,
+                    compression=options.compression,
+                    level=options.level,
+                    shuffle=options.shuffle,
+                    scaleoffset=options.scaleoffset,
+                    flush=False)
+
+    try:
+        for filename in sorted(args):
+            for snapshot in artemis_data.read(filename):
+                cubes.append(snapshot)
+    finally:
+        cubes.close()
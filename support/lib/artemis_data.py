@@ -23,22 +23,59 @@
 #   2022-02-06  Todd Valentic
 #               Fix error in saving exposure_time 
 #
+#   2026-10-17  Todd Valentic
+#               Decode pixels as a zero-copy view of the record
+#
+#   2026-10-17  Todd Valentic
+#               Add metadata_only option to skip the image data
+#
+#   2026-10-17  Todd Valentic
+#               Stream records into a preallocated buffer
+#
+#   2026-10-17  Todd Valentic
+#               Add read_many batch reader
+#
+#   2026-10-17  Todd Valentic
+#               Accept an open file object (fileobj) in read
+#
+#   2026-10-17  Todd Valentic
+#               Record decompress and decode times (metrics)
+#
+#   2026-10-17  Todd Valentic
+#               Import h5py and PIL only when writing
+#
+#   2026-10-17  Todd Valentic
+#               Encode 8/16 bit PNGs directly (artemis_png)
+#
+#   2026-10-17  Todd Valentic
+#               Remove the unread shared buffers when read_many stops
+#
+#   2026-10-17  Todd Valentic
+#               Note what a header only read of a bz2 file costs
+#
 ##########################################################################
 
 import bz2
 import os
 import sys
+import mmap
+import shutil
 import struct
-import h5py 
+import tempfile
+import contextlib
+import multiprocessing
 import numpy as np
-
-from PIL import Image, PngImagePlugin
+import metrics
 
 def as_str(v):
     # Strings from struct are fixed length and 0-padded
     # HDF5 doesn't like that, so trim off zeros
     return v.rstrip(b'\0')
 
+def as_native(pixels):
+    # Writers expect pixels in host byte order
+    return pixels.astype(pixels.dtype.newbyteorder('='), copy=False)
+
 UnitsCatalog = dict( 
     version             = '', 
     start_time          = 'Unix timetamp (UTC)',
@@ -62,6 +99,35 @@ UnitsCatalog = dict(
     image_bytes         = 'bytes' 
 )
 
+HeaderFormats = {
+    1:  '!Bi40sffi40sf7i2fi',
+    2:  '!Bi40s2fi40s40sf7i2fi',
+    3:  '!Bi40s2fi40s40s40sf7i2fi',
+    }
+
+HeaderSize = max(struct.calcsize(fmt) for fmt in HeaderFormats.values())
+
+ChunkSize = 64*1024
+
+# Pixel data is sent in network (big-endian) byte order
+
+PixelTypes = {
+    1:  np.dtype('>u1'),
+    2:  np.dtype('>u2'),
+    4:  np.dtype('>u4'),
+    }
+
+def get_option(kw, name, default=None):
+    # Options can be given directly as keywords or in the
+    # opts dictionary passed down from StoreBase.process
+
+    if name in kw:
+        return kw[name]
+
+    opts = kw.get('opts') or {}
+
+    return opts.get(name, default)
+
  
 class Snapshot:
 
@@ -69,6 +135,9 @@ class Snapshot:
 
         self.metadata = {}
         self.image = None
+        self.pixels = None
+        self.native = get_option(kw, 'native', False)
+        self.metadata_only = get_option(kw, 'metadata_only', False)
 
         if 'metadata' in kw:
             self.metadata.update(kw['metadata'])
@@ -83,7 +152,7 @@ class Snapshot:
 
     def parse_version_1(self, rawdata):
 
-        header_fmt = '!Bi40sffi40sf7i2fi'
+        header_fmt = HeaderFormats[1]
         values = struct.unpack_from(header_fmt, rawdata)
 
         self.metadata = dict( 
@@ -109,11 +178,12 @@ class Snapshot:
             image_bytes         = values[17],
             )
 
-        self.pixels = self.parse_pixels(rawdata, self.metadata, header_fmt)
+        if not self.metadata_only:
+            self.pixels = self.parse_pixels(rawdata, self.metadata, header_fmt)
 
     def parse_version_2(self, rawdata):
 
-        header_fmt = '!Bi40s2fi40s40sf7i2fi'
+        header_fmt = HeaderFormats[2]
         values = struct.unpack_from(header_fmt, rawdata)
 
         self.metadata = dict(
@@ -139,11 +209,12 @@ class Snapshot:
             image_bytes         = values[18],
             )
 
-        self.pixels = self.parse_pixels(rawdata, self.metadata, header_fmt)
+        if not self.metadata_only:
+            self.pixels = self.parse_pixels(rawdata, self.metadata, header_fmt)
 
     def parse_version_3(self, rawdata):
 
-        header_fmt = '!Bi40s2fi40s40s40sf7i2fi'
+        header_fmt = HeaderFormats[3]
         values = struct.unpack_from(header_fmt, rawdata)
 
         self.metadata = dict(
@@ -169,27 +240,53 @@ class Snapshot:
             image_bytes         = values[19],
             )
 
-        self.pixels = self.parse_pixels(rawdata, self.metadata, header_fmt)
+        if not self.metadata_only:
+            self.pixels = self.parse_pixels(rawdata, self.metadata, header_fmt)
 
 
     def parse_pixels(self, rawdata, metadata, header_fmt):
 
+        # The pixels are returned as a read-only view into rawdata
+        # in big-endian order. Only make a copy if the caller has
+        # asked for native byte order.
+
         width = metadata['width']
         height = metadata['height']
+        bytes_per_pixel = metadata['bytes_per_pixel']
+
+        if bytes_per_pixel not in PixelTypes:
+            raise ValueError('Unsupported bytes per pixel: %d' % bytes_per_pixel)
 
+        dtype = PixelTypes[bytes_per_pixel]
         image_size = width * height
+        image_bytes = image_size * dtype.itemsize
         offset = struct.calcsize(header_fmt)
-        pixels = struct.unpack_from('!%dH' % image_size, rawdata, offset)
+        available = len(rawdata) - offset
 
-        return np.array(pixels).astype(np.uint16).reshape((height,width))
+        if available < max(image_bytes, metadata['image_bytes']):
+            raise ValueError('Truncated image data: %d bytes, expected %d' % \
+                (available, max(image_bytes, metadata['image_bytes'])))
+
+        pixels = np.frombuffer(rawdata, dtype=dtype, count=image_size, offset=offset)
+        pixels = pixels.reshape((height,width))
+
+        if self.native:
+            pixels = as_native(pixels)
+
+        return pixels
 
     def write_hdf5(self, filename):
 
+        # The writers' modules are slow to load and not needed
+        # for reading, so only import them here
+
+        import h5py
+
         with h5py.File(filename, 'w') as output:
             output.attrs['version'] = 1
 
             image = output.create_dataset('image', 
-                                    data=self.pixels, 
+                                    data=as_native(self.pixels), 
                                     compression='gzip')
 
             image.attrs.update(self.metadata)
@@ -197,9 +294,19 @@ class Snapshot:
             units = output.create_group('units')
             units.attrs.update(UnitsCatalog)
 
-    def write_png(self, filename):
+    def write_png(self, filename, **kw):
+
+        # 8 and 16 bit images take the direct encoder, where kw
+        # selects the zlib level, strategy, row filter and text
+        # chunks (see artemis_png.encode_png)
 
-        im = Image.fromarray(self.pixels)
+        if self.pixels.dtype.itemsize in (1, 2):
+            import artemis_png
+            return artemis_png.write_png(filename, self.pixels, self.metadata, **kw)
+
+        from PIL import Image, PngImagePlugin
+
+        im = Image.fromarray(as_native(self.pixels))
         info = PngImagePlugin.PngInfo()
 
         for k,v in self.metadata.items():
@@ -215,12 +322,229 @@ def read(filename, *pos, **kw):
 
     #instrument = filename.split('-')[
 
-    rawdata = open(filename).read()
+    # The data can also be given as an open file object (fileobj),
+    # in which case filename is only used to detect compression.
+
+    fileobj = kw.get('fileobj')
+
+    with metrics.timer('decompress'):
+        if get_option(kw, 'metadata_only', False):
+            rawdata = read_header(filename, fileobj)
+        else:
+            rawdata = read_record(filename, fileobj=fileobj)
+
+    with metrics.timer('decode'):
+        return [Snapshot(rawdata, *pos, **kw)]
+
+@contextlib.contextmanager
+def open_record(filename, fileobj=None):
+
+    if fileobj is not None:
+        yield fileobj
+    else:
+        with open(filename, 'rb') as f:
+            yield f
+
+def read_chunks(f, filename):
+
+    # Yield the (decompressed) contents of the file in chunks
 
     if filename.endswith('bz2'):
-        rawdata = bz2.decompress(rawdata)
+        decompress = bz2.BZ2Decompressor().decompress
+    else:
+        decompress = lambda chunk: chunk
+
+    while True:
+        chunk = f.read(ChunkSize)
+        if not chunk:
+            break
+        data = decompress(chunk)
+        if data:
+            yield data
+
+def read_prefix(chunks, size):
+
+    # Collect at least size bytes from the front of the stream
+
+    rawdata = b''
+
+    for data in chunks:
+        rawdata += data
+        if len(rawdata) >= size:
+            break
 
-    return [Snapshot(rawdata, *pos, **kw)]
+    return rawdata
+
+def record_size(metadata):
+
+    bytes_per_pixel = metadata['bytes_per_pixel']
+
+    if bytes_per_pixel not in PixelTypes:
+        raise ValueError('Unsupported bytes per pixel: %d' % bytes_per_pixel)
+
+    header_size = struct.calcsize(HeaderFormats[metadata['version']])
+    image_size = metadata['width'] * metadata['height'] * bytes_per_pixel
+
+    return header_size + max(image_size, metadata['image_bytes'])
+
+def read_header(filename, fileobj=None):
+
+    # Only read enough of the file to cover the largest header.
+    # For compressed files, stop feeding the decompressor as soon
+    # as the header is available. bz2 decodes whole blocks (900 kB
+    # of data at level 9), so this still reads and decompresses
+    # the first block, which is close to half of a 1024x1024 16 bit
+    # record. The saving is mostly in skipping the pixel decode.
+
+    with open_record(filename, fileobj) as f:
+        return read_prefix(read_chunks(f, filename), HeaderSize)
+
+def read_record(filename, allocate=bytearray, fileobj=None):
+
+    # Stream the file into a single buffer sized from the header.
+    # Only one decompressed chunk is held outside the buffer at a
+    # time, so peak memory is roughly one frame.
+
+    with open_record(filename, fileobj) as f:
+
+        chunks = read_chunks(f, filename)
+        header = read_prefix(chunks, HeaderSize)
+        metadata = Snapshot(header, metadata_only=True).metadata
+
+        size = record_size(metadata)
+        rawdata = allocate(size)
+
+        pos = min(len(header), size)
+        rawdata[:pos] = header[:pos]
+        del header
+
+        for data in chunks:
+            if pos >= size:
+                break
+            count = min(len(data), size-pos)
+            rawdata[pos:pos+count] = data[:count]
+            pos += count
+
+    if pos < size:
+        raise ValueError('Truncated record: %d bytes, expected %d' % \
+            (pos, size))
+
+    return rawdata
+
+#-- Batch reader -------------------------------------------------------
+
+# Records decoded by the worker processes are handed back through
+# memory mapped files on a tmpfs instead of being pickled. Each
+# read_many call uses its own directory, which is removed at the end
+# along with any files that were not read (or were left partly
+# written by a terminated worker).
+
+SharedPath = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+class SharedBuffer:
+
+    def __init__(self, path=SharedPath):
+        fd, self.path = tempfile.mkstemp(prefix='artemis-', dir=path)
+        os.close(fd)
+
+    def __call__(self, size):
+
+        with open(self.path, 'r+b') as f:
+            f.truncate(size)
+            self.buffer = mmap.mmap(f.fileno(), size)
+
+        return self.buffer
+
+    def close(self):
+        if hasattr(self, 'buffer'):
+            self.buffer.close()
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def map_shared(path):
+
+    # The mapping stays valid after the file is removed
+
+    with open(path, 'rb') as f:
+        rawdata = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    os.remove(path)
+
+    return rawdata
+
+def read_worker(args):
+
+    filename, metadata_only, path = args
+
+    if metadata_only:
+        try:
+            return filename, read_header(filename), None, None
+        except Exception as e:
+            return filename, None, None, '%s: %s' % (e.__class__.__name__, e)
+
+    shared = SharedBuffer(path)
+
+    try:
+        read_record(filename, allocate=shared)
+        shared.close()
+        return filename, None, shared.path, None
+    except Exception as e:
+        shared.remove()
+        return filename, None, None, '%s: %s' % (e.__class__.__name__, e)
+
+def read_many(filenames, *pos, **kw):
+
+    # Decompress and decode a batch of files across a process pool.
+    #
+    # Yields (filename, snapshots, error) for each file, in input
+    # order or as they complete if ordered=False. Per-file problems
+    # are reported in error (snapshots is None) rather than raised.
+    #
+    # Options (keywords or opts):
+    #   processes - pool size, default is the number of CPUs
+    #   ordered   - keep input order (default True)
+
+    processes = get_option(kw, 'processes', None)
+    ordered = get_option(kw, 'ordered', True)
+    metadata_only = get_option(kw, 'metadata_only', False)
+
+    pool = multiprocessing.Pool(processes)
+
+    shared_dir = tempfile.mkdtemp(prefix='artemis-', dir=SharedPath)
+    jobs = [(filename, metadata_only, shared_dir) for filename in filenames]
+
+    if ordered:
+        results = pool.imap(read_worker, jobs)
+    else:
+        results = pool.imap_unordered(read_worker, jobs)
+
+    try:
+        for filename, header, path, error in results:
+
+            if error:
+                yield filename, None, error
+                continue
+
+            try:
+                if path:
+                    rawdata = map_shared(path)
+                else:
+                    rawdata = header
+                snapshots = [Snapshot(rawdata, *pos, **kw)]
+            except Exception as e:
+                yield filename, None, '%s: %s' % (e.__class__.__name__, e)
+                continue
+
+            yield filename, snapshots, None
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(shared_dir, ignore_errors=True)
 
 if __name__ == '__main__':
 
@@ -0,0 +1,236 @@
+#!/usr/bin/env python2
+
+##########################################################################
+#
+#   PNG export for Artemis snapshots
+#
+#   Encodes 8 and 16 bit grayscale images directly with numpy and
+#   zlib. The pixels are already in network byte order, which is
+#   what PNG uses, so 16 bit images need no byte swapping. The row
+#   filter and the zlib level and strategy can be chosen, and
+#   write_many encodes a batch across a process pool.
+#
+#   2026-10-17  Todd Valentic
+#               Initial implementation
+#
+##########################################################################
+
+import os
+import json
+import zlib
+import struct
+import tempfile
+import multiprocessing
+import numpy as np
+
+import artemis_data
+
+Signature = b'\x89PNG\r\n\x1a\n'
+
+# zlib strategies (Z_RLE and Z_FIXED are not named in python2's zlib)
+
+Strategies = {
+    'default':  0,
+    'filtered': 1,
+    'huffman':  2,
+    'rle':      3,
+    'fixed':    4,
+    }
+
+# PNG row filter types
+
+Filters = {
+    'none':     0,
+    'sub':      1,
+    'up':       2,
+    'average':  3,
+    'paeth':    4,
+    }
+
+BitDepths = {
+    1:  8,
+    2:  16,
+    }
+
+def make_chunk(kind, data):
+    crc = zlib.crc32(kind + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', crc)
+
+def filter_rows(raw, method, bpp):
+
+    # Apply a PNG filter to every row at once. raw is a (rows, bytes)
+    # uint8 array. The predictors only use unfiltered bytes, so no
+    # row depends on the result for another. Arithmetic is mod 256.
+
+    if method == 'none':
+        return raw
+
+    left = np.zeros_like(raw)
+    left[:, bpp:] = raw[:, :-bpp]
+
+    up = np.zeros_like(raw)
+    up[1:] = raw[:-1]
+
+    if method == 'sub':
+        return raw - left
+
+    if method == 'up':
+        return raw - up
+
+    if method == 'average':
+        return raw - ((left.astype(np.uint16) + up) >> 1).astype(np.uint8)
+
+    if method == 'paeth':
+        upleft = np.zeros_like(raw)
+        upleft[1:, bpp:] = raw[:-1, :-bpp]
+
+        a = left.astype(np.int16)
+        b = up.astype(np.int16)
+        c = upleft.astype(np.int16)
+        p = a + b - c
+        pa = np.abs(p - a)
+        pb = np.abs(p - b)
+        pc = np.abs(p - c)
+
+        predict = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, upleft))
+
+        return raw - predict
+
+    raise ValueError('Unknown PNG filter: %s' % method)
+
+def filter_image(raw, method, bpp):
+
+    # Returns the filtered rows, each prefixed by its filter type.
+    # The adaptive method picks the filter per row with the lowest
+    # sum of absolute (signed) values, like libpng.
+
+    rows, size = raw.shape
+    output = np.empty((rows, size+1), dtype=np.uint8)
+
+    if method == 'adaptive':
+        names = ['none', 'sub', 'up', 'average', 'paeth']
+        candidates = np.array([filter_rows(raw, name, bpp) for name in names])
+        scores = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+        best = scores.argmin(axis=0)
+        output[:, 0] = [Filters[names[k]] for k in best]
+        output[:, 1:] = candidates[best, np.arange(rows)]
+    else:
+        output[:, 0] = Filters[method]
+        output[:, 1:] = filter_rows(raw, method, bpp)
+
+    return output
+
+def text_chunks(metadata, text):
+
+    # 'chunks' writes one tEXt chunk per key (mango:<key>, as
+    # before), 'json' one compressed zTXt chunk (mango) with all
+    # of the keys, and None no metadata.
+
+    if not metadata or not text:
+        return []
+
+    if text == 'chunks':
+        return [make_chunk(b'tEXt', ('mango:%s' % k).encode('latin-1') + b'\0' +
+                           str(v).encode('latin-1', 'replace'))
+                for k, v in sorted(metadata.items())]
+
+    if text == 'json':
+        values = dict((k, v.decode('latin-1') if isinstance(v, bytes) else v)
+                      for k, v in metadata.items())
+        data = json.dumps(values, sort_keys=True).encode('latin-1')
+        return [make_chunk(b'zTXt', b'mango\0\0' + zlib.compress(data))]
+
+    raise ValueError('Unknown PNG text option: %s' % text)
+
+def encode_png(pixels, metadata=None, level=6, strategy='default',
+               filter='up', text='chunks'):
+
+    # Return the PNG file contents for an 8 or 16 bit grayscale image
+
+    height, width = pixels.shape
+    bpp = pixels.dtype.itemsize
+
+    if bpp not in BitDepths or pixels.dtype.kind != 'u':
+        raise ValueError('Only 8 and 16 bit images are supported, not %s' % pixels.dtype)
+
+    if strategy not in Strategies:
+        raise ValueError('Unknown zlib strategy: %s' % strategy)
+
+    # Big-endian views (from Snapshot) are used as is
+
+    pixels = np.ascontiguousarray(pixels, dtype=pixels.dtype.newbyteorder('>'))
+    raw = pixels.view(np.uint8).reshape(height, width*bpp)
+
+    data = filter_image(raw, filter, bpp)
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9, Strategies[strategy])
+    idat = compressor.compress(data.tobytes()) + compressor.flush()
+
+    header = struct.pack('>IIBBBBB', width, height, BitDepths[bpp], 0, 0, 0, 0)
+
+    chunks = [make_chunk(b'IHDR', header)]
+    chunks.extend(text_chunks(metadata, text))
+    chunks.append(make_chunk(b'IDAT', idat))
+    chunks.append(make_chunk(b'IEND', b''))
+
+    return Signature + b''.join(chunks)
+
+def write_png(filename, pixels, metadata=None, **kw):
+
+    # Written to a temporary file first so a web server never
+    # sees a partial image
+
+    data = encode_png(pixels, metadata, **kw)
+
+    path = os.path.dirname(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(prefix='.png-', dir=path)
+
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            output.write(data)
+        os.chmod(tmpname, 0o644)
+        os.rename(tmpname, filename)
+    except:
+        os.remove(tmpname)
+        raise
+
+def write_worker(args):
+
+    source, filename, options = args
+
+    try:
+        if isinstance(source, artemis_data.Snapshot):
+            snapshots = [source]
+        else:
+            snapshots = artemis_data.read(source)
+        for snapshot in snapshots:
+            snapshot.write_png(filename, **options)
+    except Exception as e:
+        return filename, '%s: %s' % (type(e).__name__, e)
+
+    return filename, None
+
+def write_many(items, processes=None, **kw):
+
+    # Encode (source, filename) pairs across a process pool, where
+    # source is a Snapshot or a record filename (read in the worker,
+    # which avoids sending the pixels between processes). Yields
+    # (filename, error) as each image is written. kw are passed to
+    # Snapshot.write_png.
+
+    jobs = [(source, filename, kw) for source, filename in items]
+
+    if processes == 1:
+        for job in jobs:
+            yield write_worker(job)
+        return
+
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        for result in pool.imap_unordered(write_worker, jobs):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -10,6 +10,12 @@
 #   2022-03-12  Todd Valentic
 #               Use stationinstrument junction table
 #
+#   2026-10-17  Todd Valentic
+#               Cache the station, device and instrument tables
+#
+#   2026-10-17  Todd Valentic
+#               Pass snapshots on to an optional quicklook builder
+#
 ##########################################################################
 
 from store_base import StoreBase
@@ -27,6 +33,17 @@ class Store(StoreBase):
     def __init__(self, *pos, **kw):
         StoreBase.__init__(self, model, artemis_data, *pos, **kw)
 
+        self.setCache([
+            model.Station,
+            model.Device,
+            model.Instrument,
+            model.StationInstrument
+            ], self.cacheTime)
+
+        # Optional quicklook.QuickLookBuilder, fed every snapshot
+
+        self.quicklook = None
+
     def getStation(self, name):
 
         match = {}
@@ -72,9 +89,7 @@ class Store(StoreBase):
 
         timestamp = self.getTimestamp(values['start_time'])
         stationinstrument = self.getStationInstrument(values['station'], values['instrument'])
-        station = self.getStation(values['station'])
         device = self.getDevice(values['device_name'])
-        instrument = self.getInstrument(values['instrument'])
 
         values['timestamp'] = timestamp 
         values['stationinstrument_id'] = stationinstrument.id
@@ -86,6 +101,12 @@ class Store(StoreBase):
             self.reportError('Failed to update database')
             return False
 
+        # QuickLookBuilder.add logs its own errors, so a quicklook
+        # problem never stops the archiving
+
+        if self.quicklook:
+            self.quicklook.add(snapshot)
+
         return True
 
 if __name__ == '__main__':
@@ -0,0 +1,187 @@
+#!/usr/bin/env python2
+
+##########################################################################
+#
+#   Synthetic Artemis records
+#
+#   Writes valid v1/v2/v3 Artemis binary records (see artemis_data)
+#   with a made up sky image. Used for benchmarks and for testing
+#   the readers without camera data.
+#
+#   2026-10-17  Todd Valentic
+#               Initial implementation
+#
+##########################################################################
+
+import os
+import bz2
+import time
+import struct
+import optparse
+import numpy as np
+
+from artemis_data import HeaderFormats, PixelTypes
+
+# Header fields in record order for each version
+
+HeaderFields = {
+    1:  ['version', 'start_time', 'station', 'latitude', 'longitude',
+         'serialnum', 'device_name', 'exposure_time', 'x', 'y',
+         'width', 'height', 'bytes_per_pixel', 'bin_x', 'bin_y',
+         'ccd_temp', 'set_point', 'image_bytes'],
+    2:  ['version', 'start_time', 'station', 'latitude', 'longitude',
+         'serialnum', 'device_name', 'label', 'exposure_time', 'x', 'y',
+         'width', 'height', 'bytes_per_pixel', 'bin_x', 'bin_y',
+         'ccd_temp', 'set_point', 'image_bytes'],
+    3:  ['version', 'start_time', 'station', 'latitude', 'longitude',
+         'serialnum', 'device_name', 'label', 'instrument',
+         'exposure_time', 'x', 'y', 'width', 'height',
+         'bytes_per_pixel', 'bin_x', 'bin_y', 'ccd_temp', 'set_point',
+         'image_bytes'],
+    }
+
+def make_metadata(version=3, width=1024, height=1024, bytes_per_pixel=2,
+                  bin_x=1, bin_y=1, start_time=None, station='cfs',
+                  instrument='greenline', device_name='camera_a'):
+
+    # The width and height are the sensor size before binning
+
+    width = width // bin_x
+    height = height // bin_y
+
+    if start_time is None:
+        start_time = int(time.time())
+
+    return dict(
+        version             = version,
+        start_time          = int(start_time),
+        station             = station,
+        latitude            = 40.8,
+        longitude           = -121.5,
+        serialnum           = 12345,
+        device_name         = device_name,
+        label               = '%s %s' % (station, instrument),
+        instrument          = instrument,
+        exposure_time       = 120.0,
+        x                   = 0,
+        y                   = 0,
+        width               = width,
+        height              = height,
+        bytes_per_pixel     = bytes_per_pixel,
+        bin_x               = bin_x,
+        bin_y               = bin_y,
+        ccd_temp            = -30.0,
+        set_point           = -30.0,
+        image_bytes         = width * height * bytes_per_pixel,
+        )
+
+def make_pixels(metadata, seed=0):
+
+    # Dark background with vignetting, a diffuse airglow band and
+    # read noise. Compresses about as well as a real sky image.
+
+    height = metadata['height']
+    width = metadata['width']
+    dtype = PixelTypes[metadata['bytes_per_pixel']]
+    maxval = min(np.iinfo(dtype).max, 4095*metadata['bin_x']*metadata['bin_y'])
+
+    random = np.random.RandomState(seed)
+
+    y, x = np.mgrid[-1:1:height*1j, -1:1:width*1j]
+    r2 = x*x + y*y
+
+    image = 0.1 + 0.3*np.exp(-((y-0.3*x-0.2)**2)/0.05)
+    image *= np.clip(1.0-0.5*r2, 0, 1)
+    image = image*maxval + random.normal(0, 0.01*maxval, image.shape)
+
+    return np.clip(image, 0, maxval).astype(dtype)
+
+def pack_record(metadata, pixels):
+
+    version = metadata['version']
+    values = [metadata[field] for field in HeaderFields[version]]
+
+    header = struct.pack(HeaderFormats[version], *values)
+
+    return header + pixels.astype(PixelTypes[metadata['bytes_per_pixel']]).tobytes()
+
+def make_filename(metadata, compress=True):
+
+    timestr = time.strftime('%Y%m%d-%H%M%S', time.gmtime(metadata['start_time']))
+    filename = 'mango-%s-%s-%s.dat' % (metadata['station'],
+                                      metadata['instrument'], timestr)
+
+    if compress:
+        filename += '.bz2'
+
+    return filename
+
+def write_record(path, metadata, pixels, compress=True):
+
+    filename = os.path.join(path, make_filename(metadata, compress))
+    record = pack_record(metadata, pixels)
+
+    if compress:
+        record = bz2.compress(record)
+
+    with open(filename, 'wb') as output:
+        output.write(record)
+
+    return filename
+
+def generate(path, count=1, cadence=120, compress=True, seed=0, **kw):
+
+    # Write count records cadence seconds apart. Returns the filenames.
+
+    metadata = make_metadata(**kw)
+    pixels = make_pixels(metadata, seed)
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    filenames = []
+
+    for k in range(count):
+        record = dict(metadata, start_time=metadata['start_time']+k*cadence)
+        filenames.append(write_record(path, record, pixels, compress))
+
+    return filenames
+
+if __name__ == '__main__':
+
+    usage = '%prog [options] path'
+
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option('-n','--count',dest='count',type='int',default=10,
+                        help='Number of records [%default]')
+    parser.add_option('-v','--version',dest='version',type='int',default=3,
+                        help='Record version (1,2,3) [%default]')
+    parser.add_option('-W','--width',dest='width',type='int',default=1024,
+                        help='Sensor width [%default]')
+    parser.add_option('-H','--height',dest='height',type='int',default=1024,
+                        help='Sensor height [%default]')
+    parser.add_option('-b','--bin',dest='binning',type='int',default=1,
+                        help='Binning in x and y [%default]')
+    parser.add_option('-B','--bytes',dest='bytes_per_pixel',type='int',default=2,
+                        help='Bytes per pixel (1,2,4) [%default]')
+    parser.add_option('--no-bz2',dest='compress',action='store_false',default=True,
+                        help='Do not compress the records')
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error('Missing output path')
+
+    filenames = generate(args[0],
+                         count=options.count,
+                         compress=options.compress,
+                         version=options.version,
+                         width=options.width,
+                         height=options.height,
+                         bin_x=options.binning,
+                         bin_y=options.binning,
+                         bytes_per_pixel=options.bytes_per_pixel)
+
+    for filename in filenames:
+        print(filename)
@@ -0,0 +1,335 @@
+#!/usr/bin/env python2
+
+##########################################################################
+#
+#   Ingest metrics
+#
+#   Counters and latency histograms for the stages of the ingest path,
+#   labeled by station and datatype. Rendered in the Prometheus text
+#   format to a file (node exporter textfile collector) or served on
+#   a local port, and summarized for the log.
+#
+#   Metrics are off until enable() is called. Until then the timers
+#   and counters do nothing.
+#
+#   Labels are kept per thread, so the library code (artemis_data,
+#   store_base) does not need to know the station or datatype:
+#
+#       with metrics.labels(station='lwl', datatype='greenline'):
+#           with metrics.timer('decode'):
+#               ...
+#
+#   2026-10-17  Todd Valentic
+#               Initial implementation
+#
+##########################################################################
+
+import os
+import time
+import tempfile
+import threading
+import contextlib
+import BaseHTTPServer
+
+from collections import OrderedDict
+
+Prefix = 'mango_ingest'
+
+# Latency histogram bucket bounds (seconds)
+
+Buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60)
+
+Counters = OrderedDict([
+    ('messages',    'News articles processed'),
+    ('files',       'Data files processed'),
+    ('bytes',       'Attachment bytes processed'),
+    ('records',     'Records written to the database'),
+    ('errors',      'Failed files and writes'),
+    ])
+
+registry = None
+
+Context = threading.local()
+
+class Histogram:
+
+    def __init__(self, buckets=Buckets):
+        self.buckets = buckets
+        self.counts = [0]*len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+
+        self.count += 1
+        self.sum += value
+
+        for k,bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[k] += 1
+                break
+
+    def copy(self):
+        other = Histogram(self.buckets)
+        other.counts = list(self.counts)
+        other.count = self.count
+        other.sum = self.sum
+        return other
+
+    def subtract(self, other):
+        delta = self.copy()
+        if other:
+            delta.counts = [a-b for a,b in zip(self.counts,other.counts)]
+            delta.count -= other.count
+            delta.sum -= other.sum
+        return delta
+
+    def merge(self, other):
+        self.counts = [a+b for a,b in zip(self.counts,other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q):
+
+        # Upper bound of the bucket holding the q'th observation
+
+        if not self.count:
+            return 0
+
+        total = 0
+
+        for bound,count in zip(self.buckets,self.counts):
+            total += count
+            if total >= q*self.count:
+                return bound
+
+        return float('inf')
+
+def escape(value):
+    value = str(value).replace('\\','\\\\').replace('\n','\\n')
+    return value.replace('"','\\"')
+
+def format_labels(labels, **extra):
+
+    items = list(labels) + sorted(extra.items())
+
+    if not items:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (k,escape(v)) for k,v in items)
+
+class Registry:
+
+    def __init__(self, prefix=Prefix, buckets=Buckets):
+
+        self.prefix = prefix
+        self.buckets = buckets
+        self.lock = threading.Lock()
+
+        self.counters = OrderedDict()       # (name,labels): value
+        self.histograms = OrderedDict()     # (stage,labels): Histogram
+
+        self.lastSummary = time.time()
+        self.lastCounters = {}
+        self.lastHistograms = {}
+
+    def count(self, name, value=1, **labels):
+
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key,0) + value
+
+    def observe(self, stage, seconds, **labels):
+
+        key = (stage, tuple(sorted(labels.items())))
+
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.buckets)
+            self.histograms[key].observe(seconds)
+
+    def render(self):
+
+        # Prometheus text exposition format
+
+        lines = []
+
+        with self.lock:
+            counters = self.counters.items()
+            histograms = [(key,hist.copy()) for key,hist in self.histograms.items()]
+
+        for name,desc in Counters.items():
+            metric = '%s_%s_total' % (self.prefix,name)
+            lines.append('# HELP %s %s' % (metric,desc))
+            lines.append('# TYPE %s counter' % metric)
+            for (key,labels),value in counters:
+                if key == name:
+                    lines.append('%s%s %s' % (metric,format_labels(labels),value))
+
+        metric = '%s_stage_seconds' % self.prefix
+        lines.append('# HELP %s Time spent in each ingest stage' % metric)
+        lines.append('# TYPE %s histogram' % metric)
+
+        for (stage,labels),hist in histograms:
+            labels = (('stage',stage),) + labels
+            total = 0
+            for bound,count in zip(hist.buckets,hist.counts):
+                total += count
+                lines.append('%s_bucket%s %d' % \
+                    (metric,format_labels(labels,le='%g' % bound),total))
+            lines.append('%s_bucket%s %d' % \
+                (metric,format_labels(labels,le='+Inf'),hist.count))
+            lines.append('%s_sum%s %f' % (metric,format_labels(labels),hist.sum))
+            lines.append('%s_count%s %d' % (metric,format_labels(labels),hist.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+
+        # Replace the file atomically so readers never see a partial copy
+
+        path = os.path.dirname(os.path.abspath(filename))
+        fd, tmpname = tempfile.mkstemp(prefix='.metrics-', dir=path)
+
+        try:
+            with os.fdopen(fd,'w') as output:
+                output.write(self.render())
+            os.chmod(tmpname,0o644)
+            os.rename(tmpname,filename)
+        except:
+            os.remove(tmpname)
+            raise
+
+    def summary(self):
+
+        # Per stage and counter totals since the last summary,
+        # summed over the labels.
+
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict((key,hist.copy()) for key,hist in self.histograms.items())
+
+        now = time.time()
+        elapsed = max(now-self.lastSummary,1e-6)
+
+        totals = OrderedDict()
+        for (name,labels),value in sorted(counters.items()):
+            delta = value - self.lastCounters.get((name,labels),0)
+            totals[name] = totals.get(name,0) + delta
+
+        stages = OrderedDict()
+        for (stage,labels),hist in sorted(histograms.items()):
+            delta = hist.subtract(self.lastHistograms.get((stage,labels)))
+            if stage in stages:
+                stages[stage].merge(delta)
+            else:
+                stages[stage] = delta
+
+        self.lastSummary = now
+        self.lastCounters = counters
+        self.lastHistograms = histograms
+
+        lines = ['Ingest metrics for the last %d secs' % elapsed]
+
+        for name,value in totals.items():
+            lines.append('  %-12s %10d  %8.2f/s' % (name,value,value/elapsed))
+
+        for stage,hist in stages.items():
+            if not hist.count:
+                continue
+            lines.append('  %-12s n=%-8d mean=%.1fms p95<=%gms total=%.1fs' % \
+                (stage,hist.count,1000*hist.sum/hist.count,
+                 1000*hist.quantile(0.95),hist.sum))
+
+        return lines
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        body = registry.render() if registry else ''
+
+        self.send_response(200)
+        self.send_header('Content-Type','text/plain; version=0.0.4')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *pos):
+        pass
+
+def serve(port, address='127.0.0.1'):
+
+    # Serve the metrics over HTTP from a background thread
+
+    server = BaseHTTPServer.HTTPServer((address,port),Handler)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+def enable(*pos, **kw):
+
+    global registry
+
+    if registry is None:
+        registry = Registry(*pos, **kw)
+
+    return registry
+
+def current_labels():
+    return getattr(Context,'labels',{})
+
+@contextlib.contextmanager
+def labels(**kw):
+
+    # Labels applied to the metrics recorded by this thread
+
+    saved = current_labels()
+    merged = dict(saved)
+    merged.update(kw)
+
+    Context.labels = merged
+
+    try:
+        yield
+    finally:
+        Context.labels = saved
+
+def count(name, value=1, **kw):
+
+    if registry is None:
+        return
+
+    merged = dict(current_labels())
+    merged.update(kw)
+
+    registry.count(name, value, **merged)
+
+def observe(stage, seconds, **kw):
+
+    if registry is None:
+        return
+
+    merged = dict(current_labels())
+    merged.update(kw)
+
+    registry.observe(stage, seconds, **merged)
+
+@contextlib.contextmanager
+def timer(stage, **kw):
+
+    if registry is None:
+        yield
+        return
+
+    start = time.time()
+
+    try:
+        yield
+    finally:
+        observe(stage, time.time()-start, **kw)
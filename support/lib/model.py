@@ -25,15 +25,39 @@
 #   2026-02-20  Todd Valentic
 #               Add ability to set database from environment
 #
+#   2026-10-17  Todd Valentic
+#               Add unique constraint on image timestamp/stationinstrument
+#
+#   2026-10-17  Todd Valentic
+#               Partition image table by month
+#
+#   2026-10-17  Todd Valentic
+#               Create the engine on first use. Pool settings from
+#               the environment (MANGO_DATABASE_*)
+#
+#   2026-10-17  Todd Valentic
+#               Add unique constraint on quicklookmovie timestamp/stationinstrument
+#
+#   2026-10-17  Todd Valentic
+#               Complete the image partitioning migration steps
+#
+#   2026-10-17  Todd Valentic
+#               Create partitions through an end month, one per
+#               transaction, moving their rows out of image_default
+#
 ###########################################################################
 
 import os
+import re
+import datetime
+import threading
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine, Column, ForeignKey, func, Index
+from sqlalchemy import create_engine, Column, ForeignKey, func, Index, text
 from sqlalchemy import ForeignKeyConstraint, UniqueConstraint
 from sqlalchemy import DateTime, String, BigInteger, Integer, Float, Boolean, Numeric
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm import scoped_session, Session
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.dialects import postgresql
 
@@ -43,16 +67,98 @@ DEFAULT_URI = 'postgresql://@/mango'
 
 database = os.environ.get("MANGO_DATABASE_URI", DEFAULT_URI)
 
-session = scoped_session(sessionmaker())
+# The engine is created on first use (see get_engine) with these
+# settings from the environment:
+#
+#   MANGO_DATABASE_POOL_SIZE            connections kept open (5)
+#   MANGO_DATABASE_MAX_OVERFLOW         extra connections allowed (10)
+#   MANGO_DATABASE_POOL_TIMEOUT         secs to wait for a connection (30)
+#   MANGO_DATABASE_POOL_RECYCLE         secs before reconnecting (3600)
+#   MANGO_DATABASE_POOL_PRE_PING        test connections before use (yes)
+#   MANGO_DATABASE_STATEMENT_TIMEOUT    statement timeout in ms (none)
+#   MANGO_DATABASE_PREPARE_THRESHOLD    executions before a statement is
+#                                       prepared on the server (psycopg 3
+#                                       only, psycopg2 has no support)
+
+def as_bool(value):
+    return value.strip().lower() in ('1', 'yes', 'true', 'on')
+
+PoolSettings = [
+    ('MANGO_DATABASE_POOL_SIZE',        'pool_size',        int),
+    ('MANGO_DATABASE_MAX_OVERFLOW',     'max_overflow',     int),
+    ('MANGO_DATABASE_POOL_TIMEOUT',     'pool_timeout',     int),
+    ('MANGO_DATABASE_POOL_RECYCLE',     'pool_recycle',     int),
+    ('MANGO_DATABASE_POOL_PRE_PING',    'pool_pre_ping',    as_bool),
+    ]
+
+engine = None
+engineLock = threading.Lock()
+
+def engine_options(uri, environ=os.environ):
+
+    options = dict(pool_pre_ping=True, pool_recycle=3600)
+
+    for name, key, convert in PoolSettings:
+        if environ.get(name):
+            options[key] = convert(environ[name])
+
+    connect_args = {}
+    drivername = make_url(uri).drivername
+
+    timeout = environ.get('MANGO_DATABASE_STATEMENT_TIMEOUT')
+
+    if timeout and drivername.split('+')[0] == 'postgresql':
+        connect_args['options'] = '-c statement_timeout=%d' % int(timeout)
+
+    threshold = environ.get('MANGO_DATABASE_PREPARE_THRESHOLD')
+
+    if threshold and drivername == 'postgresql+psycopg':
+        connect_args['prepare_threshold'] = int(threshold)
+
+    if connect_args:
+        options['connect_args'] = connect_args
+
+    return options
+
+def get_engine():
+
+    global engine
+
+    with engineLock:
+        if engine is None:
+            engine = create_engine(database, **engine_options(database))
+            Base.metadata.bind = engine
+
+    return engine
+
+def configure(uri):
+
+    # Use a different database. Only needed before the first query
+    # or to switch databases (the current engine is closed).
+
+    global database, engine
+
+    session.remove()
+
+    with engineLock:
+        if engine is not None:
+            engine.dispose()
+        database = uri
+        engine = None
+
+def make_session():
+    return Session(bind=get_engine())
+
+session = scoped_session(make_session)
 
 Base = declarative_base()
 Base.query = session.query_property()
-Base.metadata.bind = create_engine(database)
 
 #-- Utility functions --------------------------------------------
 
 def create():
-    Base.metadata.create_all()
+    Base.metadata.create_all(bind=get_engine())
+    create_partitions()
 
 def add(entry):
     session.add(entry)
@@ -66,6 +172,9 @@ def save(entry):
 def merge(entry):
     return session.merge(entry)
 
+def execute(statement):
+    return session.execute(statement)
+
 def commit():
     session.commit()
 
@@ -75,6 +184,135 @@ def rollback():
 def remove():
     session.remove()
 
+#-- Partitions ---------------------------------------------------
+#
+# The image table is range partitioned by month on timestamp. Each
+# month is stored in image_YYYY_MM. Rows outside of the existing
+# partitions land in image_default, so create partitions ahead of
+# time (see bin/partitions.py). A partition created later takes its
+# rows out of image_default.
+
+def month_start(date):
+    return datetime.date(date.year, date.month, 1)
+
+def next_month(date):
+    if date.month == 12:
+        return datetime.date(date.year+1, 1, 1)
+    return datetime.date(date.year, date.month+1, 1)
+
+def partition_name(tablename, date):
+    return '%s_%04d_%02d' % (tablename, date.year, date.month)
+
+def list_partitions(tablename='image'):
+
+    sql = text("""
+        select child.relname from pg_inherits
+            join pg_class parent on pg_inherits.inhparent = parent.oid
+            join pg_class child on pg_inherits.inhrelid = child.oid
+        where parent.relname = :tablename
+        order by child.relname
+        """)
+
+    return [row[0] for row in session.execute(sql, dict(tablename=tablename))]
+
+def create_partitions(start=None, months=3, tablename='image', end=None):
+
+    # Create the partitions for each month from start through the
+    # given number of months past end (both default to the current
+    # month). Each partition is committed on its own, so an error
+    # keeps the months before it and a rerun picks up from there.
+    # Returns the names of the new partitions.
+
+    now = datetime.datetime.utcnow()
+    date = month_start(start or now)
+    last = max(date, month_start(end or now))
+
+    for k in range(months):
+        last = next_month(last)
+
+    session.execute(text(
+        'create table if not exists %s_default partition of %s default' %
+        (tablename, tablename)))
+    session.commit()
+
+    existing = set(list_partitions(tablename))
+    created = []
+
+    while date <= last:
+        name = partition_name(tablename, date)
+        if name not in existing:
+            try:
+                create_partition(tablename, name, date, next_month(date))
+                session.commit()
+            except:
+                session.rollback()
+                raise
+            created.append(name)
+        date = next_month(date)
+
+    return created
+
+def create_partition(tablename, name, start, end):
+
+    # Postgres will not attach a range while the default partition
+    # holds rows in it, so build the table, move those rows into it
+    # and then attach it.
+
+    bounds = dict(start='%s 00:00:00+00' % start, end='%s 00:00:00+00' % end)
+
+    session.execute(text(
+        'create table %s (like %s including defaults including constraints)' %
+        (name, tablename)))
+
+    session.execute(text(
+        'insert into %s select * from %s_default '
+        'where timestamp >= :start and timestamp < :end' %
+        (name, tablename)), bounds)
+
+    session.execute(text(
+        'delete from %s_default '
+        'where timestamp >= :start and timestamp < :end' %
+        tablename), bounds)
+
+    session.execute(text(
+        "alter table %s attach partition %s "
+        "for values from ('%s') to ('%s')" %
+        (tablename, name, bounds['start'], bounds['end'])))
+
+def detach_partitions(before, drop=False, tablename='image'):
+
+    # Detach (and optionally drop) the monthly partitions that end
+    # on or before the given date. Detached tables can be archived
+    # with pg_dump and dropped later.
+
+    pattern = re.compile('^%s_(\\d{4})_(\\d{2})$' % tablename)
+    before = month_start(before)
+    detached = []
+
+    for name in list_partitions(tablename):
+
+        match = pattern.match(name)
+
+        if not match:
+            continue
+
+        year, month = [int(value) for value in match.groups()]
+
+        if next_month(datetime.date(year, month, 1)) > before:
+            continue
+
+        session.execute(text('alter table %s detach partition %s' %
+            (tablename, name)))
+
+        if drop:
+            session.execute(text('drop table %s' % name))
+
+        detached.append(name)
+
+    session.commit()
+
+    return detached
+
 #------------------------------------------------------------------------------
 # Stations
 #------------------------------------------------------------------------------
@@ -165,8 +403,11 @@ class Image(Base):
     __tablename__ = 'image'
 
 
-    id              = Column(Integer, primary_key=True)
-    timestamp       = Column(DateTime(timezone=True))
+    # Partitioned by month on timestamp (see create_partitions).
+    # The partition key needs to be part of the primary key.
+
+    id              = Column(Integer, primary_key=True, autoincrement=True)
+    timestamp       = Column(DateTime(timezone=True), primary_key=True)
     device_id       = Column(Integer, ForeignKey('device.id'))
     serialnum       = Column(Integer)
 
@@ -185,8 +426,46 @@ class Image(Base):
 
     stationinstrument_id = Column(Integer, ForeignKey('stationinstrument.id'))
 
+    # The unique constraint is the conflict target for batched
+    # upserts. Existing databases need it added by hand:
+    #
+    #   alter table image add constraint image_timestamp_stationinstrument_id_key
+    #       unique (timestamp, stationinstrument_id);
+    #
+    # An existing unpartitioned table can be migrated by renaming it,
+    # creating the new table and partitions, then copying the rows.
+    # Renaming a table keeps the names of its index, constraints and
+    # id sequence, which the new table needs, so rename those too
+    # (skip the unique constraint if it was never added):
+    #
+    #   begin;
+    #   alter table image rename to image_old;
+    #   alter table image_old rename constraint image_pkey to image_old_pkey;
+    #   alter table image_old rename constraint image_timestamp_stationinstrument_id_key
+    #       to image_old_timestamp_stationinstrument_id_key;
+    #   alter index stationinstrument_id_timestamp_idx
+    #       rename to image_old_stationinstrument_id_timestamp_idx;
+    #   alter sequence image_id_seq rename to image_old_id_seq;
+    #   commit;
+    #
+    #   (run create() and then bin/partitions.py --start <first month in
+    #   image_old>, which creates the months through the current one)
+    #
+    #   insert into image (id, timestamp, device_id, serialnum, latitude,
+    #       longitude, exposure_time, ccd_temp, set_point, image_bytes,
+    #       x, y, width, height, bin_x, bin_y, stationinstrument_id)
+    #   select id, timestamp, device_id, serialnum, latitude,
+    #       longitude, exposure_time, ccd_temp, set_point, image_bytes,
+    #       x, y, width, height, bin_x, bin_y, stationinstrument_id
+    #   from image_old;
+    #   select setval('image_id_seq', (select max(id) from image));
+    #   drop table image_old;
+
     __table_args__ = (
         Index('stationinstrument_id_timestamp_idx',stationinstrument_id,timestamp),
+        UniqueConstraint('timestamp','stationinstrument_id',
+            name='image_timestamp_stationinstrument_id_key'),
+        dict(postgresql_partition_by='RANGE (timestamp)'),
     )
 
     def __repr__(self):
@@ -201,8 +480,17 @@ class QuickLookMovie(Base):
     timestamp       = Column(DateTime(timezone=True))
     stationinstrument_id = Column(Integer, ForeignKey('stationinstrument.id'))
 
+    # One movie per night (timestamp is the start of the night).
+    # The unique constraint is the conflict target for batched
+    # upserts. Existing databases need it added by hand:
+    #
+    #   alter table quicklookmovie add constraint quicklookmovie_timestamp_stationinstrument_id_key
+    #       unique (timestamp, stationinstrument_id);
+
     __table_args__ = (
         Index('quicklookmovie_stationinstrument_id_timestamp_idx',stationinstrument_id,timestamp),
+        UniqueConstraint('timestamp','stationinstrument_id',
+            name='quicklookmovie_timestamp_stationinstrument_id_key'),
     )
 
     def __repr__(self):
@@ -0,0 +1,335 @@
+#!/usr/bin/env python2
+
+##########################################################################
+#
+#   Incremental quicklook movies
+#
+#   Each snapshot is downscaled and tone mapped to an 8 bit frame as
+#   it is ingested and appended to the current night's segment for
+#   its station and instrument. A segment is an artemis_cube file,
+#   so appends survive restarts. When a segment closes (a frame for
+#   the next night arrives or no frames arrive for a while) it is
+#   optionally encoded into a movie and its QuickLookMovie row is
+#   upserted through the store. Late frames for an earlier night
+#   go to that night's own segment, which is closed once idle, and
+#   leave the current night open.
+#
+#   Segments carry a closed attribute. Those still open when the
+#   process stopped are picked up again by recover() and closed as
+#   usual once idle. Movies are encoded in a background thread so
+#   the ingest does not wait for the encoder.
+#
+#   2026-10-17  Todd Valentic
+#               Initial implementation
+#
+#   2026-10-17  Todd Valentic
+#               Log quicklook errors instead of raising them
+#
+#   2026-10-17  Todd Valentic
+#               Adopt segments left open by an earlier run (recover)
+#               Encode movies in a background thread
+#
+#   2026-10-17  Todd Valentic
+#               Keep late frames out of the current night's segment
+#
+##########################################################################
+
+import os
+import time
+import Queue
+import datetime
+import threading
+import subprocess
+import pytz
+import h5py
+import numpy as np
+
+import model
+
+from artemis_data import as_native
+from artemis_cube import ImageCube, night_of
+
+# Default movie encoder command, filled in with width, height, rate
+# and output
+
+Encoder = 'ffmpeg -y -loglevel error -f rawvideo -pix_fmt gray ' \
+          '-s %(width)dx%(height)d -r %(rate)d -i - ' \
+          '-vcodec libx264 -pix_fmt yuv420p %(output)s'
+
+def downscale(image, size):
+
+    # Block average so the longest side is at most size pixels
+
+    height, width = image.shape
+    factor = max(1, int(np.ceil(max(height, width) / float(size))))
+
+    if factor == 1:
+        return image.astype(np.float32)
+
+    height = height // factor * factor
+    width = width // factor * factor
+
+    blocks = image[:height, :width].reshape(height//factor, factor,
+                                            width//factor, factor)
+
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+def tone_map(image, low=1.0, high=99.5, gamma=0.5):
+
+    # Stretch between the low and high percentiles (estimated from
+    # a subsample) and apply a gamma curve
+
+    sample = image[::4, ::4]
+    lo, hi = np.percentile(sample, [low, high])
+
+    scaled = (image - lo) / max(hi - lo, 1.0)
+    np.clip(scaled, 0, 1, out=scaled)
+
+    if gamma != 1:
+        np.power(scaled, gamma, out=scaled)
+
+    return (scaled * 255 + 0.5).astype(np.uint8)
+
+def make_frame(pixels, size=256, **kw):
+    return tone_map(downscale(as_native(pixels), size), **kw)
+
+class Frame:
+
+    # What ImageCube.append needs from a snapshot
+
+    def __init__(self, pixels, metadata):
+        self.pixels = pixels
+        self.metadata = metadata
+
+class Segment:
+
+    def __init__(self, cube, updated=None):
+        self.cube = cube
+        self.updated = updated or time.time()
+
+class QuickLookBuilder:
+
+    Template = '%(station)s/%(instrument)s/%(station)s-%(instrument)s-%(night)s-quicklook.h5'
+
+    def __init__(self, store, path, template=Template, size=256, idle=7200,
+                 offset=0, encoder=None, rate=10, **kw):
+
+        # store is the artemis_store.Store used for the lookups and
+        # for writing the QuickLookMovie rows. kw are passed to
+        # tone_map.
+
+        self.store = store
+        self.log = store.log
+        self.path = path
+        self.template = template
+        self.size = size
+        self.idle = idle
+        self.offset = offset
+        self.encoder = encoder
+        self.rate = rate
+        self.toneOptions = kw
+
+        self.segments = {}
+        self.movies = Queue.Queue()
+        self.encoderThread = None
+
+    def filename(self, station, instrument, night):
+        values = dict(station=station, instrument=instrument, night=night)
+        return os.path.join(self.path, self.template % values)
+
+    def add(self, snapshot):
+
+        # Errors (a damaged segment file, a frame size change during
+        # the night) are logged so they never stop the ingest
+
+        try:
+            return self.addFrame(snapshot)
+        except Exception:
+            self.log.exception('Quicklook: failed to add frame')
+            return False
+
+    def addFrame(self, snapshot):
+
+        if snapshot.pixels is None:
+            return False
+
+        metadata = snapshot.metadata
+        station = metadata['station']
+        instrument = metadata['instrument']
+        night = night_of(metadata['start_time'], self.offset)
+
+        key = (station, instrument, night)
+
+        if key not in self.segments:
+
+            # A new night closes the earlier ones. A late frame only
+            # reopens its own night.
+
+            for other in list(self.segments):
+                if other[:2] == key[:2] and other[2] < night:
+                    self.close(other)
+
+            filename = self.filename(station, instrument or 'unknown', night)
+            cube = ImageCube(filename, compression='gzip', level=1)
+            cube.output.attrs['closed'] = 0
+            self.segments[key] = Segment(cube)
+
+        segment = self.segments[key]
+        segment.updated = time.time()
+
+        frame = make_frame(snapshot.pixels, self.size, **self.toneOptions)
+
+        values = dict((k, metadata[k]) for k in
+                        ('start_time', 'station', 'instrument', 'exposure_time'))
+
+        return segment.cube.append(Frame(frame, values))
+
+    def recover(self):
+
+        # Adopt the segments left open by an earlier run. They keep
+        # their file time as the last update, so stale ones are
+        # closed right away.
+
+        for path, dirs, files in os.walk(self.path):
+            for name in sorted(files):
+                if name.endswith('.h5'):
+                    try:
+                        self.adopt(os.path.join(path, name))
+                    except Exception:
+                        self.log.exception('Quicklook: failed to recover %s' % name)
+
+        self.closeIdle()
+
+    def adopt(self, filename):
+
+        updated = os.path.getmtime(filename)
+        cube = ImageCube(filename)
+        attrs = cube.output.attrs
+
+        if attrs.get('closed', 1) or not len(cube):
+            cube.close()
+            return
+
+        night = night_of(int(cube.start_times()[0]), self.offset)
+        key = (attrs['station'], attrs['instrument'], night)
+
+        self.log.info('Quicklook: recovered %s' % filename)
+
+        self.segments[key] = Segment(cube, updated)
+
+    def closeIdle(self):
+
+        now = time.time()
+
+        for key, segment in list(self.segments.items()):
+            if now - segment.updated >= self.idle:
+                self.close(key)
+
+    def close(self, key):
+
+        segment = self.segments.pop(key)
+        station, instrument, night = key
+
+        count = len(segment.cube)
+        filename = segment.cube.filename
+        segment.cube.output.attrs['closed'] = 1
+        segment.cube.close()
+
+        if not count:
+            return
+
+        self.log.info('Quicklook %s %s %s: %d frames' % \
+            (station, instrument, night, count))
+
+        if self.encoder:
+            self.queueMovie(filename)
+
+        self.updateRecord(station, instrument, night)
+
+    def closeAll(self):
+
+        # Close every segment and wait for the queued movies
+
+        for key in list(self.segments):
+            self.close(key)
+
+        if self.encoderThread:
+            self.movies.put(None)
+            self.encoderThread.join()
+            self.encoderThread = None
+
+    def queueMovie(self, filename):
+
+        if not self.encoderThread:
+            self.encoderThread = threading.Thread(target=self.encodeMovies)
+            self.encoderThread.daemon = True
+            self.encoderThread.start()
+
+        self.movies.put(filename)
+
+    def encodeMovies(self):
+
+        while True:
+            filename = self.movies.get()
+
+            if filename is None:
+                break
+
+            try:
+                self.encodeMovie(filename)
+            except Exception:
+                self.log.exception('Failed to encode %s' % filename)
+
+    def encodeMovie(self, filename):
+
+        # The frames are read first so the segment is not held open
+        # (a late frame may reopen it) while the encoder runs
+
+        output = os.path.splitext(filename)[0] + '.mp4'
+
+        with h5py.File(filename, 'r') as cube:
+            frames = cube['image'][:]
+
+        count, height, width = frames.shape
+
+        command = self.encoder % dict(width=width, height=height,
+                                      rate=self.rate, output=output)
+
+        process = subprocess.Popen(command.split(), stdin=subprocess.PIPE)
+
+        try:
+            for index in range(count):
+                process.stdin.write(frames[index].tobytes())
+        finally:
+            process.stdin.close()
+
+        if process.wait():
+            raise RuntimeError('Encoder exited with %d' % process.returncode)
+
+        return output
+
+    def nightStart(self, night):
+
+        # Start of the night in UTC (see artemis_cube.night_of)
+
+        date = datetime.datetime.strptime(night, '%Y%m%d')
+        date -= datetime.timedelta(hours=self.offset)
+
+        return date.replace(tzinfo=pytz.utc)
+
+    def updateRecord(self, station, instrument, night):
+
+        try:
+            stationinstrument = self.store.getStationInstrument(station, instrument)
+            stationinstrument_id = stationinstrument.id
+        except AttributeError:
+            self.log.error('Quicklook: unknown station/instrument %s/%s' % \
+                (station, instrument))
+            return False
+
+        values = dict(timestamp=self.nightStart(night),
+                      stationinstrument_id=stationinstrument_id)
+
+        match = ['timestamp', 'stationinstrument_id']
+
+        return self.store.update(values, model.QuickLookMovie, primary_keys=match)
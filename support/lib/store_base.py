@@ -7,16 +7,54 @@
 #   2020-10-14  Todd Valentic
 #               Initial implementation
 #
+#   2026-10-17  Todd Valentic
+#               Add batched upserts (batchSize, batchTime)
+#
+#   2026-10-17  Todd Valentic
+#               Add in-memory cache for lookup tables
+#
+#   2026-10-17  Todd Valentic
+#               Pass optional file object to the data handler
+#
+#   2026-10-17  Todd Valentic
+#               Record lookup, update and commit times (metrics)
+#
+#   2026-10-17  Todd Valentic
+#               Keep the queued rows when a batch fails to commit
+#
+#   2026-10-17  Todd Valentic
+#               Write a failed batch one row at a time, dropping the
+#               rows that still fail after batchRetries flushes
+#
 #####################################################################
 
 import sys
 import os
+import time
+
+import metrics
 
+from collections import OrderedDict
 from sqlalchemy.orm import class_mapper
+from sqlalchemy.dialects.postgresql import insert
+
+class CachedRecord:
+
+    # Detached copy of a row's column values. Unlike the ORM
+    # instance, it is not expired (and reloaded) on commit.
+
+    def __init__(self, instance, table):
+        for column in class_mapper(table).columns:
+            setattr(self, column.key, getattr(instance, column.key))
+
+    def __repr__(self):
+        return '<CachedRecord %s>' % self.__dict__
 
 class StoreBase:
 
-    def __init__(self, model, dataHandler, log=None, exitOnError=True):
+    def __init__(self, model, dataHandler, log=None, exitOnError=True,
+                 batchSize=0, batchTime=None, cacheTime=None,
+                 batchRetries=3):
 
         if not log:
             self.setupBasicLogger()
@@ -26,6 +64,28 @@ class StoreBase:
         self.model = model
         self.dataHandler = dataHandler
         self.exitOnError = exitOnError
+        self.filename = None
+
+        self.pending = OrderedDict()
+        self.pendingSince = None
+        self.failures = 0
+        self.setBatch(batchSize, batchTime, batchRetries)
+
+        self.cache = {}
+        self.cacheTables = set()
+        self.cacheTime = cacheTime
+
+    def setBatch(self, size, seconds=None, retries=3):
+
+        # Queue updates and write them as multi-row upserts once
+        # size rows are pending or the oldest is seconds old.
+        # A size of 0 writes each record as it arrives. A failed
+        # batch is written row by row, and rows that still fail are
+        # queued again and dropped after retries failed flushes.
+
+        self.batchSize = size or 0
+        self.batchTime = seconds
+        self.batchRetries = max(retries or 1, 1)
 
     def setupBasicLogger(self):
 
@@ -35,6 +95,7 @@ class StoreBase:
         logging.basicConfig(level=logging.INFO)
 
     def reportError(self, msg):
+        metrics.count('errors')
         self.log.error('Filename: %s' % self.filename)
         if self.exitOnError:
             self.log.exception(msg)
@@ -42,12 +103,17 @@ class StoreBase:
         else:
             self.log.error(msg)
 
-    def process(self,filename,opts=None,*pos,**kw):
+    def process(self,filename,opts=None,fileobj=None,*pos,**kw):
         
         self.filename = filename
 
+        readopts = dict(opts=opts)
+
+        if fileobj is not None:
+            readopts['fileobj'] = fileobj
+
         try:
-            snapshots = self.dataHandler.read(filename,opts=opts)
+            snapshots = self.dataHandler.read(filename,**readopts)
         except:
             self.reportError('Problem loading data')
             return False
@@ -61,9 +127,68 @@ class StoreBase:
         # Filled in by child class
         pass
 
+    def setCache(self, tables, seconds=None):
+
+        # Small, rarely changing tables are loaded whole and served
+        # from memory. They are reloaded on a miss or when older
+        # than seconds (None keeps them until a miss).
+
+        self.cacheTables = set(tables)
+        self.cacheTime = seconds
+        self.cache = {}
+
+    def loadCache(self,table):
+
+        records = [CachedRecord(instance,table) for instance in table.query.all()]
+
+        entry = dict(loaded=time.time(), records=records, index={})
+        self.cache[table] = entry
+
+        self.log.debug('Cached %d rows from %s' % (len(records),table.__tablename__))
+
+        return entry
+
+    def searchCache(self,entry,match):
+
+        fields = tuple(sorted(match))
+
+        if fields not in entry['index']:
+            index = {}
+            for record in entry['records']:
+                key = tuple(getattr(record,field) for field in fields)
+                index.setdefault(key,record)
+            entry['index'][fields] = index
+
+        key = tuple(match[field] for field in fields)
+
+        return entry['index'][fields].get(key)
+
+    def lookupCache(self,match,table):
+
+        entry = self.cache.get(table)
+
+        if entry and self.cacheTime is not None:
+            if time.time()-entry['loaded'] > self.cacheTime:
+                entry = None
+
+        if entry:
+            instance = self.searchCache(entry,match)
+            if instance:
+                return instance
+
+        entry = self.loadCache(table)
+
+        return self.searchCache(entry,match)
+
     def lookup(self,match,table):
-        instance = table.query.filter_by(**match).first()
-        return instance
+
+        with metrics.timer('lookup'):
+
+            if table in self.cacheTables:
+                return self.lookupCache(match,table)
+
+            instance = table.query.filter_by(**match).first()
+            return instance
 
     def lookupOrAdd(self,match,table):
         instance = table.query.filter_by(**match).first()
@@ -94,28 +219,190 @@ class StoreBase:
 
         match = dict((key,values[key]) for key in primary_keys)
 
-        instance = table.query.filter_by(**match).first()
+        if self.batchSize:
+            return self.queue(values,table,primary_keys)
 
-        if instance:
-            for k,v in values.iteritems():
-                setattr(instance,k,v)
-            prefix = 'Updating'
-        else:
-            instance = table(**values)
-            self.model.add(instance)
-            prefix = 'Adding'
+        with metrics.timer('update'):
+
+            instance = table.query.filter_by(**match).first()
+
+            if instance:
+                for k,v in values.iteritems():
+                    setattr(instance,k,v)
+                prefix = 'Updating'
+            else:
+                instance = table(**values)
+                self.model.add(instance)
+                prefix = 'Adding'
 
         self.log.info('%s %s' % (prefix,match))
 
         try:
-            self.model.commit()
+            with metrics.timer('commit'):
+                self.model.commit()
         except:
             self.model.rollback()
             self.log.exception('Failed to commit')
             return False
 
+        metrics.count('records')
+
         return True
 
+    def queue(self,values,table,primary_keys):
+
+        # Later values for the same key replace earlier ones since
+        # a single upsert cannot touch the same row twice.
+
+        rows = self.pending.setdefault((table,tuple(primary_keys)),OrderedDict())
+        rows[tuple(values[key] for key in primary_keys)] = values
+
+        if self.pendingSince is None:
+            self.pendingSince = time.time()
+
+        if self.flushDue():
+            return self.flush()
+
+        return True
+
+    def numPending(self):
+        return sum(len(rows) for rows in self.pending.values())
+
+    def flushDue(self):
+
+        if not self.pending:
+            return False
+
+        if self.numPending() >= self.batchSize:
+            return True
+
+        if self.batchTime is not None:
+            return time.time()-self.pendingSince >= self.batchTime
+
+        return False
+
+    def flush(self):
+
+        if not self.pending:
+            return True
+
+        pending = self.pending
+        since = self.pendingSince
+        count = self.numPending()
+
+        self.pending = OrderedDict()
+        self.pendingSince = None
+
+        try:
+            with metrics.timer('update'):
+                for (table,primary_keys),rows in pending.items():
+                    self.upsert(table,primary_keys,rows.values())
+            with metrics.timer('commit'):
+                self.model.commit()
+        except:
+            self.model.rollback()
+            self.log.exception('Failed to commit %d rows' % count)
+            failed = self.flushRows(pending)
+            self.retry(failed,since)
+            return False
+
+        self.failures = 0
+
+        metrics.count('records',count)
+
+        self.log.info('Committed %d rows' % count)
+
+        return True
+
+    def flushRows(self,pending):
+
+        # Commit the rows one at a time to get past the bad ones.
+        # Returns the rows that failed.
+
+        failed = OrderedDict()
+        committed = 0
+
+        for (table,primary_keys),rows in pending.items():
+            for key,row in rows.items():
+                try:
+                    self.upsert(table,primary_keys,[row])
+                    self.model.commit()
+                except:
+                    self.model.rollback()
+                    failed.setdefault((table,primary_keys),OrderedDict())[key] = row
+                else:
+                    committed += 1
+
+        metrics.count('records',committed)
+
+        self.log.info('Committed %d rows one at a time' % committed)
+
+        return failed
+
+    def retry(self,failed,since):
+
+        # Queue the failed rows for the next flush, or drop them
+        # after batchRetries failed flushes in a row
+
+        if not failed:
+            self.failures = 0
+            return
+
+        count = sum(len(rows) for rows in failed.values())
+
+        self.failures += 1
+
+        if self.failures < self.batchRetries:
+            self.log.error('Keeping %d failed rows queued (attempt %d of %d)' %
+                            (count,self.failures,self.batchRetries))
+            self.restore(failed,since)
+            return
+
+        for (table,primary_keys),rows in failed.items():
+            for key in rows:
+                self.log.error('Dropping %s row %s' % (table.__tablename__,key))
+
+        metrics.count('errors',count)
+
+        self.failures = 0
+
+    def restore(self,pending,since):
+
+        # Put the rows back ahead of any queued since. Those are
+        # newer, so their values win.
+
+        for key,rows in self.pending.items():
+            pending.setdefault(key,OrderedDict()).update(rows)
+
+        self.pending = pending
+        self.pendingSince = since
+
+    def upsert(self,table,primary_keys,rows):
+
+        # One INSERT ... ON CONFLICT DO UPDATE per set of columns
+
+        groups = OrderedDict()
+
+        for row in rows:
+            groups.setdefault(tuple(sorted(row)),[]).append(row)
+
+        for columns,group in groups.items():
+
+            stmt = insert(table.__table__).values(group)
+
+            updates = dict((key,stmt.excluded[key])
+                            for key in columns if key not in primary_keys)
+
+            if updates:
+                stmt = stmt.on_conflict_do_update(
+                            index_elements=primary_keys,
+                            set_=updates)
+            else:
+                stmt = stmt.on_conflict_do_nothing(
+                            index_elements=primary_keys)
+
+            self.model.execute(stmt)
+
 if __name__ == '__main__':
 
     filename = sys.argv[1]